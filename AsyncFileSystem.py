@@ -0,0 +1,172 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from FileSystem import FileSystem
+from File import FileSeek
+
+default_workers = 8
+
+
+class AsyncFileSystem:
+    """
+    An asyncio front end for a mounted FileSystem. Every operation runs on a
+    bounded pool of worker threads, so coroutines never hold up the event
+    loop on device I/O. The FileSystem is thread safe, and its block cache
+    merges concurrent reads of one block into a single device read (see
+    Fetch), so many coroutines can share one mounted image.
+    """
+
+    def __init__(self, fs, maxWorkers=default_workers):
+        """
+        :param fs:         the mounted FileSystem
+        :param maxWorkers: most operations running at once; the rest wait their turn
+        """
+        self.fs = fs
+        self.executor = ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix="AsyncFileSystem")
+
+    @staticmethod
+    async def mount(filename, maxWorkers=default_workers, **mountArgs):
+        """ FileSystem.mount, run on a worker; mountArgs are passed on to it """
+        asyncFS = AsyncFileSystem(None, maxWorkers)
+        asyncFS.fs = await asyncFS.run(FileSystem.mount, filename, **mountArgs)
+        return asyncFS
+
+    async def unmount(self):
+        await self.run(self.fs.unmount)
+        self.executor.shutdown(wait=False)  # nothing is left running on it
+
+    async def run(self, func, *args, **kwargs):
+        """ await func(*args, **kwargs), called on one of the workers """
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(func, *args, **kwargs))
+
+    async def open(self, path, mode="r", writeBuffer=0):
+        """
+        FileSystem.open
+        :return: an AsyncFile, or None if there is no such file
+        """
+        file = await self.run(self.fs.open, path, mode, writeBuffer)
+        if file is None:
+            return None
+        return AsyncFile(self, file)
+
+    async def read(self, path, size=-1, offset=0):
+        """
+        read size bytes (all of the rest for -1) of a file from offset
+        :return: the bytes, None if there is no such file
+        """
+        def readAt():
+            file = self.fs.open(path, "r")
+            if file is None:
+                return None
+            file.seek(offset)
+            return file.read(size)
+        return await self.run(readAt)
+
+    async def write(self, path, data, offset=0):
+        """
+        write data into a file at offset
+        :return: number of bytes written, None if there is no such file
+        """
+        def writeAt():
+            file = self.fs.open(path, "w")
+            if file is None:
+                return None
+            file.seek(offset)
+            return file.write(data)
+        return await self.run(writeAt)
+
+    async def listdir(self, path=None):
+        """
+        the names in a directory (the current one for None), without "." and ".."
+        :return: list of names, None if there is no such directory
+        """
+        def names():
+            dirInode, dirParent = self.fs.namei(path)
+            if dirInode is None:
+                return None
+            if not dirInode.isDirectory():
+                print("Error: directory is actually a file")
+                return None
+            children = self.fs.getDirectory(dirInode, dirParent).get_children()
+            return [name for name in children if name not in (".", "..")]
+        return await self.run(names)
+
+    async def mkdir(self, path, dirFormat=None):
+        await self.run(self.fs.makeDir, path, dirFormat)
+
+    async def mkfile(self, path):
+        await self.run(self.fs.makeFile, path)
+
+    async def sync(self):
+        await self.run(self.fs.sync)
+
+
+class AsyncFile:
+    """
+    A File whose calls run on its AsyncFileSystem's workers. Like a File,
+    it keeps one offset, so it is for one coroutine at a time; coroutines
+    that work on the same file in parallel each open their own.
+    """
+
+    def __init__(self, asyncFS, file):
+        self.asyncFS = asyncFS
+        self.file = file
+
+    async def read(self, size=-1):
+        return await self.asyncFS.run(self.file.read, size)
+
+    async def write(self, data):
+        return await self.asyncFS.run(self.file.write, data)
+
+    async def seek(self, pos, from_what=FileSeek.BEGINNING):
+        return await self.asyncFS.run(self.file.seek, pos, from_what)
+
+    def tell(self):
+        return self.file.tell()
+
+    async def truncate(self, len=None):
+        return await self.asyncFS.run(self.file.truncate, len)
+
+    async def sync(self):
+        await self.asyncFS.run(self.file.sync)
+
+    async def close(self):
+        await self.asyncFS.run(self.file.close)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+# Nosetests
+def test_async_file_system():
+    FileSystem.createFileSystem("testAsync", 2048, 1024)
+    testWrite = bytes(i % 251 for i in range(40 * 1024))
+
+    async def session():
+        asyncFS = await AsyncFileSystem.mount("testAsync.dev", maxWorkers=4)
+        await asyncFS.mkdir("d")
+        await asyncio.gather(*[asyncFS.mkfile("d/f" + str(i)) for i in range(6)])
+        assert sorted(await asyncFS.listdir("d")) == ["f" + str(i) for i in range(6)]
+        assert await asyncFS.listdir("missing") is None
+        assert await asyncFS.write("d/f1", testWrite) == len(testWrite)
+        async with await asyncFS.open("d/f2", "w") as testFile:
+            await testFile.write(b"A cat is Here")
+            await testFile.seek(2)
+            assert await testFile.read(3) == b"cat"
+            assert testFile.tell() == 5
+        await asyncFS.unmount()
+
+        # a cold cache: the concurrent reads share the blocks' device reads
+        asyncFS = await AsyncFileSystem.mount("testAsync.dev", maxWorkers=4)
+        reads = await asyncio.gather(*[asyncFS.read("d/f1") for i in range(8)])
+        assert all(r == testWrite for r in reads)
+        assert await asyncFS.read("d/f2", 3, 2) == b"cat"
+        assert await asyncFS.read("d/missing") is None
+        await asyncFS.sync()
+        await asyncFS.unmount()
+
+    asyncio.run(session())
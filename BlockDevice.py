@@ -1,6 +1,16 @@
 import os
+import mmap
+import threading
 
 default_blocksize = 1024
+# most platforms cap the number of buffers in one preadv/pwritev at 1024
+try:
+    iov_max = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    iov_max = 1024
+if iov_max <= 0:
+    iov_max = 1024
+
 class BlockDevice:
     """ The BlockDevice is the API that a file system is built on.
         Any block device supports block-level reads and writes.
@@ -51,7 +61,7 @@ class BlockDevice:
         return int(f_parts[1])
 
     def __init__(self, filename="blocks.1024.dev", blockCount=-1,
-            blocksize=default_blocksize, create=False):
+            blocksize=default_blocksize, create=False, use_mmap=False):
         """
             Create a new BlockDevice from a given filename. Used for
             creating a new one as well as opening an existing one.
@@ -59,9 +69,14 @@ class BlockDevice:
         :param blockCount: how big the device should be, in blocks
         :param blocksize:  how big each block should be
         :param create:     whether to create the file or just open it
+        :param use_mmap:   map the device file into memory, so blocks can be
+                           handed out as memoryview slices (see view_block)
         """
 
         self.filename = filename
+        self.map = None
+        self.mapView = None
+        self.lock = threading.Lock()  # for the seek + read/write pairs, where there is no preadv
         if create:
             if blockCount <= 0:
                 print("invalid device size: {}".format(blockCount))
@@ -83,23 +98,68 @@ class BlockDevice:
             info = os.stat(self.filename)
             self.num_blocks = int(info.st_size / self.blocksize)
             self.handle = open(self.filename, 'rb+', buffering=0)
+        if use_mmap:
+            # length 0 maps the whole file, which is num_blocks * blocksize
+            self.map = mmap.mmap(self.handle.fileno(), 0)
+            self.mapView = memoryview(self.map)
 
     def close(self):
         """ Close the underlying file in preparation for shutdown """
+        if self.map is not None:
+            self.map.flush()
+            self.mapView.release()
+            try:
+                self.map.close()
+            except BufferError:
+                # someone still holds a block view; the mapping goes away
+                # once the last view does
+                print("Warning: BlockDevice.close(): block views still in use")
+            self.map = None
+            self.mapView = None
         self.handle.flush()  # sync any buffers to disk
         self.handle.close()
 
+    def sync(self):
+        """ Push everything written so far to stable storage """
+        if self.map is not None:
+            self.map.flush()
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+
+    def is_mapped(self):
+        return self.map is not None
+
+    def view_block(self, block_num):
+        """
+        Zero-copy access to a block of a memory-mapped device
+        :param block_num: which block to view
+        :return:          writable memoryview of the block; writes to it
+                          go straight to the mapped device file
+        """
+        assert self.map is not None, "view_block on a device that is not mapped"
+        assert 0 <= block_num < self.num_blocks, "view_block outside the device"
+        start = block_num * self.blocksize
+        return self.mapView[start:start + self.blocksize]
+
     def read_block(self, block_num, buff):
         """
         Half of the action of a block device: read a block
         :param block_num: which block to read
         :param buff:      bytearray to read the data in to, assumed to be blocksize long
         """
-        assert block_num < self.num_blocks, "read_block past end of device"
+        assert 0 <= block_num < self.num_blocks, "read_block outside the device"
         assert len(buff) == self.blocksize, "bad buff size to read_block"
         #print("read_Block, block_num: " + str(block_num) + " ; " + str(block_num * self.blocksize))
-        self.handle.seek(block_num * self.blocksize)
-        num_read = self.handle.readinto(buff)
+        if self.map is not None:
+            buff[:] = self.view_block(block_num)
+            return
+        if hasattr(os, "preadv"):
+            # positional: threads never share a seek position
+            num_read = os.preadv(self.handle.fileno(), [buff], block_num * self.blocksize)
+        else:
+            with self.lock:
+                self.handle.seek(block_num * self.blocksize)
+                num_read = self.handle.readinto(buff)
         assert num_read == self.blocksize, "ERROR: read_block buffer / file not block aligned"
 
     def write_block(self, block_num, buff, pad=False):
@@ -109,7 +169,7 @@ class BlockDevice:
         :param buff:      bytearray holding data to write, assumed to be blocksize long
         :param pad:       if this is true, add null bytes to pad input up to blocksize
         """
-        assert block_num < self.num_blocks, "write_block past end of device"
+        assert 0 <= block_num < self.num_blocks, "write_block outside the device"
 
         if pad and (len(buff) < self.blocksize):
             pad_len = self.blocksize - len(buff)
@@ -117,12 +177,80 @@ class BlockDevice:
             # print("padded buffer to {}".format(len(buff)))
 
         assert len(buff) == self.blocksize, "bad buff size to write_block"
-        # todo: keep track of the file handle's seek location, and only seek when needed
-        self.handle.seek(block_num * self.blocksize)
-        num_written = self.handle.write(buff)
+        if self.map is not None:
+            start = block_num * self.blocksize
+            self.mapView[start:start + self.blocksize] = buff
+            return
+        if hasattr(os, "pwritev"):
+            num_written = os.pwritev(self.handle.fileno(), [buff], block_num * self.blocksize)
+        else:
+            with self.lock:
+                self.handle.seek(block_num * self.blocksize)
+                num_written = self.handle.write(buff)
         assert num_written == self.blocksize, (
                 "ERROR: write_block buffer / file not block aligned {}".format(num_written))
 
+    @staticmethod
+    def contiguous_runs(block_nums):
+        """
+        Group block numbers into runs of consecutive blocks
+        :param block_nums: block numbers, in any order, no duplicates
+        :return:           list of runs, each a list of indexes into block_nums
+                           whose blocks are consecutive on the device
+        """
+        order = sorted(range(len(block_nums)), key=lambda i: block_nums[i])
+        runs = []
+        for i in order:
+            if (runs and len(runs[-1]) < iov_max and
+                    block_nums[runs[-1][-1]] + 1 == block_nums[i]):
+                runs[-1].append(i)
+            else:
+                runs.append([i])
+        return runs
+
+    def read_blocks(self, block_nums, buffs):
+        """
+        Vectored read: read many blocks, one preadv per contiguous run
+        :param block_nums: which blocks to read
+        :param buffs:      one blocksize-long bytearray per block number
+        """
+        assert len(block_nums) == len(buffs), "read_blocks needs one buffer per block"
+        for block_num, buff in zip(block_nums, buffs):
+            assert 0 <= block_num < self.num_blocks, "read_blocks outside the device"
+            assert len(buff) == self.blocksize, "bad buff size to read_blocks"
+        if self.map is not None or not hasattr(os, "preadv"):
+            for block_num, buff in zip(block_nums, buffs):
+                self.read_block(block_num, buff)
+            return
+        for run in BlockDevice.contiguous_runs(block_nums):
+            num_read = os.preadv(self.handle.fileno(), [buffs[i] for i in run],
+                                 block_nums[run[0]] * self.blocksize)
+            assert num_read == len(run) * self.blocksize, (
+                    "ERROR: read_blocks buffer / file not block aligned")
+
+    def write_blocks(self, block_nums, buffs, pad=False):
+        """
+        Vectored write: write many blocks, one pwritev per contiguous run
+        :param block_nums: which blocks to write
+        :param buffs:      one bytearray per block number, each blocksize long
+        :param pad:        if this is true, add null bytes to pad short buffers up to blocksize
+        """
+        assert len(block_nums) == len(buffs), "write_blocks needs one buffer per block"
+        for block_num, buff in zip(block_nums, buffs):
+            assert 0 <= block_num < self.num_blocks, "write_blocks outside the device"
+            if pad and (len(buff) < self.blocksize):
+                buff.extend((self.blocksize - len(buff))*b'\x00')
+            assert len(buff) == self.blocksize, "bad buff size to write_blocks"
+        if self.map is not None or not hasattr(os, "pwritev"):
+            for block_num, buff in zip(block_nums, buffs):
+                self.write_block(block_num, buff)
+            return
+        for run in BlockDevice.contiguous_runs(block_nums):
+            num_written = os.pwritev(self.handle.fileno(), [buffs[i] for i in run],
+                                     block_nums[run[0]] * self.blocksize)
+            assert num_written == len(run) * self.blocksize, (
+                    "ERROR: write_blocks buffer / file not block aligned {}".format(num_written))
+
     def blocks_to_bytes(self, blocknum):
         return blocknum * self.blocksize
 
@@ -148,3 +276,31 @@ def test_write_read_block():
     for i in range(bd.blocksize):
         assert buff[i] == i % 256, "data mismatch in test_write_read_block"
 
+def test_mmap_view_block():
+    bd = BlockDevice('block.dev', 4, create=True)
+    bd.close()
+    bd = BlockDevice('block.dev', use_mmap=True)
+    view = bd.view_block(2)
+    view[0:5] = b"hello"
+    buff = bytearray(bd.blocksize)
+    bd.read_block(2, buff)
+    assert buff[0:5] == b"hello", "read_block does not see writes through view_block"
+    view.release()
+    bd.close()
+    bd = BlockDevice('block.dev')
+    buff = bytearray(bd.blocksize)
+    bd.read_block(2, buff)
+    assert buff[0:5] == b"hello", "mapped write did not reach the device file"
+
+def test_write_read_blocks():
+    bd = BlockDevice('block.dev', 8, create=True)
+    block_nums = [5, 1, 2, 3, 7]
+    buffs = [bytearray([n]) * bd.blocksize for n in block_nums]
+    bd.write_blocks(block_nums, buffs)
+    assert BlockDevice.contiguous_runs(block_nums) == [[1, 2, 3], [0], [4]]
+    bd.close()
+    bd = BlockDevice('block.dev')
+    buffs = [bytearray(bd.blocksize) for n in block_nums]
+    bd.read_blocks(block_nums, buffs)
+    for n, buff in zip(block_nums, buffs):
+        assert buff == bytearray([n]) * bd.blocksize, "data mismatch in test_write_read_blocks"
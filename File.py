@@ -1,11 +1,16 @@
 import FileSystem
 from enum import Enum
 from INode import *
+import io
+import struct
+import zlib
 
 class FileSeek(Enum):
     BEGINNING = 0
     CURRENT   = 1
     END       = 2
+    DATA      = 3  # the next offset >= pos that holds data
+    HOLE      = 4  # the next offset >= pos in a hole (or the end of the file)
 
 def inode_to_object(filesystem, inode:INode, parent):
     """ takes an INode - if it's a file, creates a File
@@ -15,74 +20,255 @@ def inode_to_object(filesystem, inode:INode, parent):
     if inode.flags == INodeType.FILE:
         return File(inode, parent)
     if inode.flags == INodeType.DIRECTORY:
-        return Directory(inode, parent)
+        return inode.parentFS.getDirectory(inode, parent)
     print("unknown inode type in inode_to_object")
     return None
 
-class File(object):
+class File(io.RawIOBase):
     """ A File is a wrapper for an iNode that provides arbitrary-
         length / non-aligned reads, and keeps track of the current
-        read (/write) offset.
+        read (/write) offset. It is an io.RawIOBase, so it can be
+        wrapped in io.BufferedReader etc. (see FileSystem.openBuffered)
+
+        With a writeBuffer size, small sequential writes are collected and
+        written to the iNode a whole number of blocks at a time, once
+        writeBuffer bytes have built up, or on flush / sync / close.
     """
-    def __init__(self, my_inode, parent:INode, offset=0):
+    def __init__(self, my_inode, parent:INode, offset=0, writeBuffer=0):
+        super(File, self).__init__()
         self.inode = my_inode
         self.offset = offset
         self.parent = parent
+        self.writeBuffer = writeBuffer
+        self.pending = bytearray()  # buffered data, to be written at pendingOffset
+        self.pendingOffset = 0
 
+    def readable(self):
+        return True
 
-    def read(self, buff):
-        self.inode.read(buff,self.offset)
-        return len(buff)
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buff):
+        """ read from the offset into buff, stopping at the end of the file
+            :return: number of bytes read, 0 at the end of the file
+        """
+        self.flush()
+        count = min(len(buff), self.inode.length - self.offset)
+        if count <= 0:
+            return 0
+        self.inode.read(memoryview(buff).cast("B")[:count], self.offset)
+        self.offset += count
+        return count
+
+    def read(self, size=-1):
+        """ given a buffer, read into it and return the number of bytes read;
+            given a size, return up to size bytes (all of the rest for -1)
+        """
+        if size is None or isinstance(size, int):
+            return super(File, self).read(size)
+        return self.readinto(size)
 
     def write(self, buff):
-        self.inode.write(buff,self.offset)
+        if self.pending and self.offset != self.pendingOffset + len(self.pending):
+            self.flush()  # not sequential
+        if not self.pending and len(buff) >= self.writeBuffer:
+            count = self.inode.write(buff,self.offset)
+            self.offset += count
+            return count
+        if not self.pending:
+            self.pendingOffset = self.offset
+        self.pending += buff
         self.offset += len(buff)
+        if len(self.pending) >= self.writeBuffer:
+            self.flushBlocks()
         return len(buff)
 
+    def flushBlocks(self):
+        """ write the whole blocks of the write buffer, keep the partial last one """
+        blockSize = self.inode.masterBlock.blockSize
+        end = self.pendingOffset + len(self.pending)
+        count = end - end % blockSize - self.pendingOffset
+        if count <= 0:
+            count = len(self.pending)
+        with memoryview(self.pending) as view:
+            self.inode.write(view[:count], self.pendingOffset)
+        del self.pending[:count]
+        self.pendingOffset += count
+
+    def flush(self):
+        """ write out the write buffer """
+        if self.pending:
+            self.inode.write(self.pending, self.pendingOffset)
+            self.pending = bytearray()
+
     def seek(self, pos, from_what = FileSeek.BEGINNING):
+        """
+        Move the offset. FileSeek.END counts back from the end of the file;
+        an int from_what (io.SEEK_SET, SEEK_CUR, SEEK_END, os.SEEK_DATA,
+        SEEK_HOLE) means what it does for os.lseek.
+        :return: the new offset
+        """
+        self.flush()
+        if from_what == io.SEEK_END:
+            self.offset = self.inode.length + pos
+            return self.offset
+        if isinstance(from_what, int):
+            from_what = FileSeek(from_what)
         if from_what == FileSeek.BEGINNING:
             self.offset = pos
         elif from_what == FileSeek.CURRENT:
             self.offset += pos
         elif from_what == FileSeek.END:
             self.offset = self.inode.length - pos
-        pass
+        elif from_what in (FileSeek.DATA, FileSeek.HOLE):
+            if from_what == FileSeek.DATA:
+                offset = self.inode.seekData(pos)
+            else:
+                offset = self.inode.seekHole(pos)
+            if offset == -1:
+                print("Error: seek: no " + from_what.name.lower() + " at or after " + str(pos))
+                return self.offset
+            self.offset = offset
+        return self.offset
+
+    def tell(self):
+        return self.offset
+
+    def chunks(self, chunkSize=io.DEFAULT_BUFFER_SIZE):
+        """ iterate over the rest of the file, chunkSize bytes at a time """
+        while True:
+            chunk = self.read(chunkSize)
+            if not chunk:
+                return
+            yield chunk
 
     def sync(self):
-        pass
+        """ write everything the file system has cached to the device """
+        self.flush()
+        self.inode.parentFS.sync()
 
-    # truncate (or extend) the file length
-    def truncate(self, len):
+    # truncate (or extend) the file length, to the offset by default
+    def truncate(self, len=None):
+        if len is None:
+            len = self.offset
+        self.flush()
         self.inode.truncate(len)
+        return len
+
+    # free the blocks under len bytes at offset, they read as zeros after
+    def punch_hole(self, offset, len):
+        self.flush()
+        self.inode.punchHole(offset, len)
 
 class Directory(File):
     """ A Directory is a File that contains a mapping from
         file names to iNode numbers.
     """
 
-    def __init__(self, my_inode:INode, parent:INode):
+    def __init__(self, my_inode:INode, parent:INode, dirFormat=None):
         super(Directory, self).__init__(my_inode, parent) # invoke File initializer
         self.children = None    # why not: = {".": self, "..": parent} ?
                                 # hint: what is the state diagram of a
                                 # directory.
+        self.index = None       # DirIndex, if this is a hashed directory
+        self.indexChecked = False
+        self.dirFormat = dirFormat  # format to give the directory if it is
+                                    # still empty, None for the file system's
+
+    def close(self):
+        # Directory objects are shared for the whole mount (see
+        # FileSystem.getDirectory), so they are never closed
+        pass
+
+    def isHashed(self):
+        if not self.indexChecked:
+            if DirIndex.isIndexed(self.inode):
+                self.index = DirIndex(self.inode)
+            self.indexChecked = True
+        return self.index is not None
+
+    def lookup(self, child_name):
+        """ returns the inode number of child_name, None if there is none """
+        with self.inode.lock.reading():
+            if self.isHashed():
+                return self.index.lookup(child_name)
+            self.ensure_cached()
+            if child_name not in self.children:
+                return None
+            return self.children[child_name].inode.inodeNum
+
+    def remove_child(self, child_name):
+        """ remove child_name from the directory, returns False if it was not there """
+        with self.inode.parentFS.operation(), self.inode.lock.writing():
+            self.inode.parentFS.dentryCache.invalidate(self.inode.inodeNum, child_name)
+            if self.isHashed():
+                if self.children is not None:
+                    self.children.pop(child_name, None)
+                return self.index.delete(child_name)
+            self.ensure_cached()
+            if child_name not in self.children:
+                return False
+            del self.children[child_name]
+            self.flush()
+            return True
 
     def add_child(self, child_name, child_inode:INode):
-        child = None
-        #print("adding child(" + str(child_inode.inodeNum) + ") to: " + str(self.inode.inodeNum) + ".")
-        if child_inode == None:
-            assert False, "missing iNode in add_child"
-        elif child_inode.isFile():
-            child = File(child_inode, self)
-        elif child_inode.isDirectory():
-            child = Directory(child_inode, self)
-        else:
-            assert False, "unknown inode type in add_child"
-        # todo: what are the conditions where we need to check this?
-        # do we have any invariants wrt. directories being cached?
-        self.ensure_cached()
-        self.children[child_name] = child
-        #print("Just added a child(" + child_name + " ): to inode" + str(self.inode.inodeNum) + " ; " + str(self.children))
-        self.flush()
+        with self.inode.parentFS.operation(), self.inode.lock.writing():
+            child = None
+            #print("adding child(" + str(child_inode.inodeNum) + ") to: " + str(self.inode.inodeNum) + ".")
+            if child_inode == None:
+                assert False, "missing iNode in add_child"
+            elif child_inode.isFile():
+                child = File(child_inode, self)
+            elif child_inode.isDirectory():
+                child = self.inode.parentFS.getDirectory(child_inode, self)
+            else:
+                assert False, "unknown inode type in add_child"
+            self.inode.parentFS.dentryCache.invalidate(self.inode.inodeNum, child_name)
+            dirFormat = self.dirFormat
+            if dirFormat is None:
+                dirFormat = self.inode.masterBlock.dirFormat
+            if not self.isHashed() and dirFormat == FileSystem.dir_format_hashed and not self.get_children():
+                # an empty directory takes its format on the first insert
+                self.index = DirIndex.create(self.inode)
+            if self.isHashed():
+                if self.children is not None:
+                    self.children[child_name] = child
+                self.index.insert(child_name, child_inode.inodeNum)
+                return
+            # todo: what are the conditions where we need to check this?
+            # do we have any invariants wrt. directories being cached?
+            self.ensure_cached()
+            self.children[child_name] = child
+            #print("Just added a child(" + child_name + " ): to inode" + str(self.inode.inodeNum) + " ; " + str(self.children))
+            self.flush()
+
+    def add_children(self, children):
+        """ add many entries at once, writing the directory once
+            :param children: dict of child name -> child INode
+        """
+        with self.inode.parentFS.operation(), self.inode.lock.writing():
+            for child_name in children:
+                self.inode.parentFS.dentryCache.invalidate(self.inode.inodeNum, child_name)
+            dirFormat = self.dirFormat
+            if dirFormat is None:
+                dirFormat = self.inode.masterBlock.dirFormat
+            if not self.isHashed() and dirFormat == FileSystem.dir_format_hashed and not self.get_children():
+                self.index = DirIndex.create(self.inode)
+            if self.isHashed():
+                if self.children is not None:
+                    for child_name, child_inode in children.items():
+                        self.children[child_name] = inode_to_object(self.inode.parentFS, child_inode, self)
+                self.index.insertMany([(name, inode.inodeNum) for name, inode in children.items()])
+                return
+            self.ensure_cached()
+            for child_name, child_inode in children.items():
+                self.children[child_name] = inode_to_object(self.inode.parentFS, child_inode, self)
+            self.flush()
 
     def get_children(self):
         self.ensure_cached()
@@ -103,18 +289,34 @@ class Directory(File):
         return strbuf
 
     def flush(self):
-        """ Write this directory out to its iNode
+        """ Write this directory out to its iNode. A hashed directory
+            writes its blocks as it changes, so has nothing to flush.
         """
+        if self.isHashed():
+            return
         strbuf = self.to_str()
         byte_buff = bytearray(strbuf, "utf-8")
+        # the length is set first, so a shorter directory leaves no stale
+        # entries behind it
+        self.inode.truncate(len(byte_buff))
         self.inode.write(byte_buff, 0)
         #print("syncing dir, {} bytes".format(str(len(byte_buff))))
 
     def ensure_cached(self):
-        self.read()
+        """ parse the directory the first time its children are needed;
+            after that they are kept up to date as the directory changes
+        """
+        if self.children is None:
+            self.read()
 
     def read(self):
         """ Read the directory from its iNode's contents """
+        if self.isHashed():
+            self.children = {}
+            for name, inodeNum in self.index.entries():
+                self.children[name] = inode_to_object(self.inode.parentFS,
+                                                      self.inode.parentFS.inodeMap.inodeMap[inodeNum], self)
+            return
         # print("fetching dir, {} bytes".format(str(self.inode.num_bytes)))
         buff = bytearray(self.inode.length)
         #print("buff length: " + str(len(buff)))
@@ -137,4 +339,191 @@ class Directory(File):
     def sync(self):
         self.flush()
 
+
+class DirIndex:
+    """ The on-disk format of a hashed directory, which keeps lookups,
+        inserts and deletes to a block or two however big it gets.
+        Block 0 of the directory is a header: the magic number, then the
+        linear hashing level and split pointer. The other blocks are
+        buckets, bucket b in block 1 + b; there are 2**level + split of
+        them. A bucket holds an entry count, then entries of inode number,
+        name length and UTF-8 name.
+        A name goes in bucket crc32(name) mod 2**level, or mod
+        2**(level + 1) if that bucket was already split this round. When
+        its bucket is full, buckets are split in order (rehashing the
+        bucket at the split pointer into itself and a new last bucket)
+        until there is room.
+    """
+    magic = b"HDIR"
+    header_format = "=4sII"   # magic, level, split
+    count_format = "=H"       # entries in a bucket
+    entry_format = "=iH"      # inode number, name length
+    max_level = 31
+
+    def __init__(self, inode:INode):
+        self.inode = inode
+        self.blockSize = inode.masterBlock.blockSize
+        header = bytearray(struct.calcsize(DirIndex.header_format))
+        inode.read(header, 0)
+        (magic, self.level, self.split) = struct.unpack(DirIndex.header_format, header)
+
+    @staticmethod
+    def isIndexed(inode:INode):
+        if inode.length < len(DirIndex.magic):
+            return False
+        magic = bytearray(len(DirIndex.magic))
+        inode.read(magic, 0)
+        return magic == DirIndex.magic
+
+    @staticmethod
+    def create(inode:INode):
+        """ turn an empty directory into an empty hashed directory """
+        blockSize = inode.masterBlock.blockSize
+        inode.truncate(2 * blockSize)
+        header = bytearray(blockSize)
+        struct.pack_into(DirIndex.header_format, header, 0, DirIndex.magic, 0, 0)
+        inode.write(header, 0)
+        index = DirIndex(inode)
+        index.writeBucket(0, [])
+        return index
+
+    def bucketCount(self):
+        return 2**self.level + self.split
+
+    def bucketOf(self, nameBytes):
+        h = zlib.crc32(nameBytes)
+        bucket = h % 2**self.level
+        if bucket < self.split:
+            bucket = h % 2**(self.level + 1)
+        return bucket
+
+    def readBucket(self, bucket):
+        """ returns the bucket's entries as a list of (name bytes, inode number) """
+        buff = bytearray(self.blockSize)
+        self.inode.read(buff, (1 + bucket) * self.blockSize)
+        (count,) = struct.unpack_from(DirIndex.count_format, buff, 0)
+        pos = struct.calcsize(DirIndex.count_format)
+        entries = []
+        for i in range(count):
+            (inodeNum, nameLen) = struct.unpack_from(DirIndex.entry_format, buff, pos)
+            pos += struct.calcsize(DirIndex.entry_format)
+            entries.append((bytes(buff[pos:pos + nameLen]), inodeNum))
+            pos += nameLen
+        return entries
+
+    def bucketBytes(self, entries):
+        return (struct.calcsize(DirIndex.count_format) +
+                sum(struct.calcsize(DirIndex.entry_format) + len(name) for name, inodeNum in entries))
+
+    def writeBucket(self, bucket, entries):
+        buff = bytearray(struct.pack(DirIndex.count_format, len(entries)))
+        for name, inodeNum in entries:
+            buff.extend(struct.pack(DirIndex.entry_format, inodeNum, len(name)))
+            buff.extend(name)
+        buff.extend(bytes(self.blockSize - len(buff)))
+        end = (2 + bucket) * self.blockSize
+        if self.inode.length < end:
+            self.inode.truncate(end)
+        self.inode.write(buff, (1 + bucket) * self.blockSize)
+
+    def writeHeader(self):
+        header = bytearray(struct.pack(DirIndex.header_format, DirIndex.magic, self.level, self.split))
+        self.inode.write(header, 0)
+
+    def splitNext(self):
+        """ split the bucket at the split pointer, False if the index can't grow """
+        if self.level >= DirIndex.max_level:
+            return False
+        oldBucket = self.split
+        newBucket = 2**self.level + self.split
+        stay = []
+        move = []
+        for name, inodeNum in self.readBucket(oldBucket):
+            if zlib.crc32(name) % 2**(self.level + 1) == oldBucket:
+                stay.append((name, inodeNum))
+            else:
+                move.append((name, inodeNum))
+        self.writeBucket(newBucket, move)
+        self.writeBucket(oldBucket, stay)
+        self.split += 1
+        if self.split == 2**self.level:
+            self.level += 1
+            self.split = 0
+        self.writeHeader()
+        return True
+
+    def lookup(self, name):
+        nameBytes = name.encode("utf-8")
+        for entryName, inodeNum in self.readBucket(self.bucketOf(nameBytes)):
+            if entryName == nameBytes:
+                return inodeNum
+        return None
+
+    def insert(self, name, inodeNum):
+        """ add (or replace) an entry, returns False if it can't be stored """
+        nameBytes = name.encode("utf-8")
+        if self.bucketBytes([(nameBytes, inodeNum)]) > self.blockSize:
+            print("Error: DirIndex.insert(): name too long")
+            return False
+        while True:
+            bucket = self.bucketOf(nameBytes)
+            entries = [entry for entry in self.readBucket(bucket) if entry[0] != nameBytes]
+            entries.append((nameBytes, inodeNum))
+            if self.bucketBytes(entries) <= self.blockSize:
+                self.writeBucket(bucket, entries)
+                return True
+            if not self.splitNext():
+                print("Error: DirIndex.insert(): directory full")
+                return False
+
+    def insertMany(self, items):
+        """ add (or replace) many (name, inode number) entries, writing each
+            affected bucket once. The index is split ahead of time to about
+            the size the new entries need.
+        """
+        pending = []
+        for name, inodeNum in items:
+            nameBytes = name.encode("utf-8")
+            if self.bucketBytes([(nameBytes, inodeNum)]) > self.blockSize:
+                print("Error: DirIndex.insertMany(): name too long")
+                continue
+            pending.append((nameBytes, inodeNum))
+        # aim for buckets about 3/4 full with just the new entries
+        wanted = self.bucketCount() + (4 * self.bucketBytes(pending)) // (3 * self.blockSize)
+        while self.bucketCount() < wanted and self.splitNext():
+            pass
+        while pending:
+            byBucket = {}
+            for entry in pending:
+                byBucket.setdefault(self.bucketOf(entry[0]), []).append(entry)
+            pending = []
+            for bucket, newEntries in byBucket.items():
+                newNames = set(name for name, inodeNum in newEntries)
+                entries = [entry for entry in self.readBucket(bucket) if entry[0] not in newNames]
+                entries.extend(newEntries)
+                if self.bucketBytes(entries) <= self.blockSize:
+                    self.writeBucket(bucket, entries)
+                else:
+                    pending.extend(newEntries)
+            if pending and not self.splitNext():
+                print("Error: DirIndex.insertMany(): directory full")
+                return False
+        return True
+
+    def delete(self, name):
+        nameBytes = name.encode("utf-8")
+        bucket = self.bucketOf(nameBytes)
+        entries = self.readBucket(bucket)
+        remaining = [entry for entry in entries if entry[0] != nameBytes]
+        if len(remaining) == len(entries):
+            return False
+        self.writeBucket(bucket, remaining)
+        return True
+
+    def entries(self):
+        """ every (name, inode number) in the directory, in bucket order """
+        for bucket in range(self.bucketCount()):
+            for name, inodeNum in self.readBucket(bucket):
+                yield name.decode("utf-8"), inodeNum
+
 # TODO: add unit tests here. :)
\ No newline at end of file
@@ -1,14 +1,39 @@
 import os
+import io
 import BlockDevice
 import struct
 import numpy as np
 from File import *
 from INode import *
 from enum import Enum
+from collections import OrderedDict
+import weakref
+import threading
+import contextlib
+from contextlib import contextmanager
+import time
+import zlib
 
 # Global constants
 default_blocksize = 1024
 default_blockcount = 1024
+default_cachebytes = 4 * 1024 * 1024
+default_readahead = 32  # most blocks read ahead of a sequential reader, see INode.readAheadAddrs
+default_flushinterval = 1.0  # seconds between Flusher passes
+
+# on-disk format versions, recorded in the master block
+format_legacy = 0         # every inode in a block of its own
+format_packed_inodes = 1  # blockSize // INode.Inode_Size inodes per inode table block
+format_inode_bitmap = 2   # adds an inode bitmap between the block map and the inode table
+format_inline_data = 3    # small files and directories are kept in their inode
+format_journal = 4        # adds a write-ahead journal for the metadata after the inode table
+format_wide_length = 5    # inode lengths are 64 bits, taking the inode magic number's place
+default_formatversion = format_wide_length
+
+# directory formats, see Directory and DirIndex in File.py
+dir_format_text = 0    # "\nname|inum" entries, parsed and rewritten whole
+dir_format_hashed = 1  # linear hashing over one-block buckets
+default_dirformat = dir_format_text
 
 
 class FileSystem:
@@ -26,10 +51,17 @@ class FileSystem:
     """
 
     @staticmethod
-    def createFileSystem(filename, blockcount=default_blockcount, blocksize=default_blocksize):
-        newFS = FileSystem(filename=filename, blockcount=blockcount, blocksize=blocksize)
+    def createFileSystem(filename, blockcount=default_blockcount, blocksize=default_blocksize,
+                         formatVersion=default_formatversion, dirFormat=default_dirformat):
+        """
+        :param dirFormat: format of directories made without asking for one
+                          (dir_format_text or dir_format_hashed)
+        """
+        newFS = FileSystem(filename=filename, blockcount=blockcount, blocksize=blocksize,
+                           formatVersion=formatVersion)
+        newFS.masterBlock.dirFormat = dirFormat
 
-        blocksToAlloc = newFS.masterBlock.inodeMapAddress+newFS.masterBlock.inodeCount
+        blocksToAlloc = newFS.masterBlock.journalAddress+newFS.masterBlock.journalBlockCount
 
         if blocksToAlloc > newFS.masterBlock.blockCount:
             print("Error: createFileSystem(): not enough blocks to create file system \n")
@@ -42,62 +74,276 @@ class FileSystem:
 
         newFS.unmount()
 
-    def __init__(self, filename, blockcount=default_blockcount, blocksize=default_blocksize):
+    def __init__(self, filename, blockcount=default_blockcount, blocksize=default_blocksize,
+                 cacheBytes=default_cachebytes, lazyInodes=False, inodeCacheSize=None,
+                 formatVersion=default_formatversion, readAhead=default_readahead):
         self.fileName = filename
-        self.masterBlock = MasterBlock(pFS=self, blockcount=blockcount, blocksize=blocksize)
+        self.masterBlock = MasterBlock(pFS=self, blockcount=blockcount, blocksize=blocksize,
+                                       formatversion=formatVersion)
         self.blockMap = BlockMap(self)
-        self.inodeMap = InodeMap(self)
-        self.blockCache = {}
+        self.inodeMap = InodeMap(self, lazyInodes, inodeCacheSize)
+        self.blockCache = BlockCache(self, cacheBytes)
+        self.readAhead = readAhead
+        self.dentryCache = DentryCache()
+        self.directories = {}  # inode number -> Directory, see getDirectory
+        self.directoriesLock = threading.Lock()  # so there never are two for one inode
         self.rBlockDev = None
+        self.journal = None  # see Journal, format_journal and later
+        self.operations = RWLock()  # see operation
         self.currentDir = None
     #load block from cache, load into cache if not availble
-    def retrieveBlock(self,blockNum,dirty=False):
-
-        if blockNum not in self.blockCache:
-            retBlock = bytearray(self.masterBlock.blockSize)
-            self.rBlockDev.read_block(blockNum, retBlock)
-            self.blockCache[blockNum] = (retBlock, dirty)
-        if (not(self.blockCache[blockNum])[1]) and dirty:
-            self.blockCache[blockNum] = ((self.blockCache[blockNum])[0],dirty)
-        #print("read update: blocknum :" + str(blockNum) + " block: " + str((self.blockCache[blockNum])[0].decode("utf-8")))
-        return (self.blockCache[blockNum])[0]
+    #on a memory-mapped device the cached block is a memoryview into the map,
+    #unless it is metadata of a journaled image (see viewsBlocks)
+    #the device read of a miss runs without the cache lock, so other threads'
+    #hits and reads go on meanwhile. A block belongs to one inode, whose lock
+    #keeps it from changing under the read. Whoever misses a block that is
+    #being read already waits for that read instead of reading it again (see
+    #Fetch).
+    def retrieveBlock(self,blockNum,dirty=False,metadata=False):
+        with self.blockCache.lock:
+            retBlock = self.blockCache.lookup(blockNum)
+            if retBlock is not None or self.viewsBlocks(metadata):
+                if retBlock is None:
+                    retBlock = self.rBlockDev.view_block(blockNum)
+                    self.blockCache.insert(blockNum, retBlock, dirty)
+                elif dirty:
+                    self.blockCache.markDirty(blockNum)
+                fetch = None
+            else:
+                fetch, mine = self.blockCache.claimFetch(blockNum)
+        if fetch is None:
+            self.blockCache.writeEvicted()
+            return retBlock
+        if not mine:
+            retBlock = self.blockCache.awaitFetch(blockNum, fetch, dirty)
+            if retBlock is None:  # the read failed, try it ourselves
+                return self.retrieveBlock(blockNum, dirty, metadata)
+            return retBlock
+        fetched = bytearray(self.masterBlock.blockSize)
+        try:
+            self.rBlockDev.read_block(blockNum, fetched)
+        except BaseException:
+            self.blockCache.endFetch(blockNum, None)
+            raise
+        #print("read update: blocknum :" + str(blockNum) + " block: " + str(fetched.decode("utf-8")))
+        return self.blockCache.endFetch(blockNum, fetched, dirty=dirty)
+
+    #batched retrieveBlock: blocks missing from the cache are fetched with one
+    #vectored device read
+    def retrieveBlocks(self,blockNums,dirty=False,metadata=False):
+        found = {}
+        claimed = []
+        waits = {}  # block number -> Fetch of another reader
+        with self.blockCache.lock:
+            for blockNum in dict.fromkeys(blockNums):
+                block = self.blockCache.lookup(blockNum)
+                if block is not None:
+                    found[blockNum] = block
+                    if dirty:
+                        self.blockCache.markDirty(blockNum)
+                elif self.viewsBlocks(metadata):
+                    found[blockNum] = self.rBlockDev.view_block(blockNum)
+                    self.blockCache.insert(blockNum, found[blockNum], dirty)
+                else:
+                    fetch, mine = self.blockCache.claimFetch(blockNum)
+                    if mine:
+                        claimed.append(blockNum)
+                    else:
+                        waits[blockNum] = fetch
+        self.blockCache.writeEvicted()
+        if claimed:
+            # read unlocked, like retrieveBlock
+            buffs = [bytearray(self.masterBlock.blockSize) for b in claimed]
+            try:
+                self.rBlockDev.read_blocks(claimed, buffs)
+            except BaseException:
+                for blockNum in claimed:
+                    self.blockCache.endFetch(blockNum, None)
+                raise
+            for blockNum, buff in zip(claimed, buffs):
+                found[blockNum] = self.blockCache.endFetch(blockNum, buff, dirty=dirty)
+        for blockNum, fetch in waits.items():
+            found[blockNum] = self.blockCache.awaitFetch(blockNum, fetch, dirty)
+            if found[blockNum] is None:
+                found[blockNum] = self.retrieveBlock(blockNum, dirty, metadata)
+        return [found[b] for b in blockNums]
+
+    def viewsBlocks(self, metadata=False):
+        """
+        whether blocks are cached as views of the mapped device. Metadata of
+        a journaled image never is: a change to a view would reach the device
+        before the Journal commit that logs it.
+        :param metadata: for blocks of pointers or of a directory
+        """
+        return self.rBlockDev.is_mapped() and not (metadata and self.journal is not None)
 
     def cacheBlock(self,blockNum,block):
-        self.blockCache[blockNum] = (block,True)
+        self.blockCache.insert(blockNum, block, True)
+        self.blockCache.writeEvicted()
         #print("write update: blocknum :" + str(blockNum) + " block: " + str(block.decode("utf-8")))
         return
 
     @staticmethod
-    def mount(filename):
+    def mount(filename, useMmap=False, cacheBytes=default_cachebytes, lazyInodes=False, inodeCacheSize=None,
+              readAhead=default_readahead, flushAge=None, flushBytes=None):
+        """
+        Load a FileSystem from its device file
+        :param filename:       the device filename
+        :param useMmap:        memory-map the device, so cached blocks are
+                               zero-copy views of the device instead of copies
+        :param cacheBytes:     memory budget of the block cache, in bytes
+        :param lazyInodes:     load each inode on first use rather than all at mount
+        :param inodeCacheSize: with lazyInodes, how many unused inodes stay loaded
+                               (None keeps every inode once loaded)
+        :param readAhead:      most blocks to read ahead of a sequential reader,
+                               0 for no read-ahead
+        :param flushAge:       with either of these, start a Flusher that writes back
+        :param flushBytes:     blocks dirty for flushAge seconds, or dirty data
+                               over flushBytes (see startFlusher)
+        :return:               the mounted FileSystem
+        """
         newFS = FileSystem(filename,
-                           blocksize=BlockDevice.BlockDevice.filename_to_blocksize(filename))
+                           blocksize=BlockDevice.BlockDevice.filename_to_blocksize(filename),
+                           cacheBytes=cacheBytes, lazyInodes=lazyInodes, inodeCacheSize=inodeCacheSize,
+                           readAhead=readAhead)
         newFS.rBlockDev = BlockDevice.BlockDevice(filename=filename,
-                                           blocksize=newFS.masterBlock.blockSize, blockCount=1, create=False)
+                                           blocksize=newFS.masterBlock.blockSize, blockCount=1, create=False,
+                                           use_mmap=useMmap)
         newFS.masterBlock.unpack(newFS.rBlockDev)
         # must update blockDev with correct size of read from disk (num_blocks) data from masterBlock unpacked
         newFS.rBlockDev.num_blocks = newFS.masterBlock.blockCount
+        if newFS.masterBlock.journalBlockCount:
+            newFS.journal = Journal(newFS)
+            if newFS.journal.replay(newFS.rBlockDev):
+                newFS.masterBlock.unpack(newFS.rBlockDev)
         newFS.blockMap.unpack(newFS.rBlockDev)
         newFS.inodeMap.unpack(newFS.rBlockDev)
-        newFS.currentDir = Directory(newFS.inodeMap.inodeMap[newFS.masterBlock.rootDirAddress],None)
+        if newFS.journal is not None:
+            newFS.journal.start()
+        newFS.currentDir = newFS.getDirectory(newFS.inodeMap.inodeMap[newFS.masterBlock.rootDirAddress],None)
+        if flushAge is not None or flushBytes is not None:
+            newFS.startFlusher(flushAge, flushBytes)
         return newFS
 
     def unmount(self,softUnmount = False):
-        if self.rBlockDev is not None and softUnmount is not True:
-            self.rBlockDev.close()
-        blockDev = BlockDevice.BlockDevice(filename=self.fileName, blocksize=int(self.masterBlock.blockSize),
-                                           blockCount=self.masterBlock.blockCount,
-                                           create=True)
-        blockDev.write_block(0, self.masterBlock.pack(), True)
-        self.blockMap.pack(blockDev)
-        self.inodeMap.pack(blockDev)
-
-        for key in self.blockCache:
-            if (self.blockCache[key])[1]:
-                blockDev.write_block(key, (self.blockCache[key])[0], True)
+        """
+        Save the FileSystem to its device. A mounted FileSystem is written
+        in place, since evicted blocks already live on the device; a new one
+        (see createFileSystem) creates its device first.
+        :param softUnmount: save, but leave the device open
+        """
+        if self.rBlockDev is not None:
+            blockDev = self.rBlockDev
+            if softUnmount is not True:
+                self.stopFlusher()
+            with self.operations.writing():
+                self.sync()
+                if self.journal is not None:
+                    self.journal.checkpoint()  # so the next mount has nothing to replay
+        else:
+            blockDev = BlockDevice.BlockDevice(filename=self.fileName, blocksize=int(self.masterBlock.blockSize),
+                                               blockCount=self.masterBlock.blockCount,
+                                               create=True)
+            blockDev.write_block(0, self.masterBlock.pack(), True)
+            self.blockMap.pack(blockDev)
+            self.inodeMap.pack(blockDev)
+            if self.masterBlock.journalBlockCount:
+                Journal(self).writeHeader(blockDev)
 
         print("FileSystem has been saved as: " + blockDev.filename)
 
-        blockDev.close()
+        if softUnmount is not True:
+            # on a mapped device the cached blocks are views that would keep
+            # the mapping alive, so they have to go first
+            if blockDev.is_mapped():
+                self.blockCache.clear()
+            blockDev.close()
+
+    def startFlusher(self, maxAge=None, maxDirtyBytes=None, interval=default_flushinterval):
+        """
+        Start writing dirty cached blocks back in the background, so they
+        do not pile up until sync or unmount
+        :param maxAge:        write back blocks dirty for this many seconds
+        :param maxDirtyBytes: keep the dirty data in the cache under this
+        :param interval:      seconds between passes
+        """
+        self.stopFlusher()
+        self.blockCache.flusher = Flusher(self.blockCache, maxAge, maxDirtyBytes, interval)
+        self.blockCache.flusher.start()
+
+    def stopFlusher(self):
+        if self.blockCache.flusher is not None:
+            self.blockCache.flusher.stop()
+            self.blockCache.flusher = None
+
+    def sync(self):
+        """
+        Make everything that changed since mount (or the last sync) durable.
+        With a Journal that is a commit; otherwise see writeInPlace.
+        """
+        with self.operations.writing():
+            if self.journal is not None:
+                self.journal.commit()
+            else:
+                self.writeInPlace()
+
+    @contextmanager
+    def operation(self):
+        """
+        one change to the file system (a write, a create, ...): a sync waits
+        for those going on and holds off new ones, so a Journal commit never
+        logs one half done. Once enough is waiting to be committed (see
+        Journal.needsCommit), the outermost operation commits as it ends.
+        """
+        with self.operations.reading():
+            yield
+        if self.journal is not None and not self.operations.isHeld() and self.journal.needsCommit():
+            self.sync()
+
+    @contextmanager
+    def metadataLocked(self):
+        """
+        hold the cache, block map and inode map still, e.g. while a Journal
+        commit gathers its records; their locks are only ever nested in this
+        order. Not for device I/O: every cache hit would wait for it.
+        """
+        with self.blockCache.lock, self.blockMap.lock, self.inodeMap.lock:
+            yield
+
+    def writeInPlace(self):
+        """
+        Write everything that changed since mount (or the last sync) to the
+        mounted device, in place: the master block if it changed, the dirty
+        regions of the block map, the dirty inodes and the dirty cached blocks.
+        Called between operations (see sync), so only the maps are locked.
+        """
+        with self.blockMap.lock, self.inodeMap.lock:
+            if self.masterBlock.dirty:
+                self.rBlockDev.write_block(0, self.masterBlock.pack(), True)
+                self.masterBlock.dirty = False
+            self.blockMap.sync(self.rBlockDev)
+            self.inodeMap.sync(self.rBlockDev)
+        self.blockCache.flush(self.rBlockDev)
+        self.rBlockDev.sync()
+
+    def printCacheStats(self):
+        print(self.blockCache.stats())
+
+    def getDirectory(self, inode, parent=None, dirFormat=None):
+        """
+        The Directory object of a directory inode. There is one per inode for
+        the whole mount, so its parsed children are reused until it changes.
+        :param parent:    parent, if the Directory has to be made
+        :param dirFormat: format for the directory if it is still empty
+        """
+        with self.directoriesLock:
+            dir = self.directories.get(inode.inodeNum)
+            if dir is None or dir.inode is not inode:
+                dir = Directory(inode, parent, dirFormat)
+                self.directories[inode.inodeNum] = dir
+            elif dirFormat is not None:
+                dir.dirFormat = dirFormat
+            return dir
 
     # TODO: part of Assignment 3.2:
     def namei(self, path):
@@ -118,11 +364,16 @@ class FileSystem:
             if not retNode.isDirectory():
                 print("Error: part in path is not a directory")
                 return None, None
-            searchDir = Directory(retNode,retParent)
-            sResult = searchDir.get_children()
-            if word in sResult:
+            childNum = self.dentryCache.lookup(retNode.inodeNum, word)
+            if childNum is DentryCache.MISS:
+                searchDir = self.getDirectory(retNode,retParent)
+                # a change to the directory in between would be undone by the insert
+                with retNode.lock.reading():
+                    childNum = searchDir.lookup(word)
+                    self.dentryCache.insert(retNode.inodeNum, word, childNum)
+            if childNum is not None:
                 retParent = retNode
-                retNode = sResult[word].inode
+                retNode = self.inodeMap.inodeMap[childNum]
             else:
                 print("Error: part in path does not exist")
                 return None, None
@@ -132,7 +383,7 @@ class FileSystem:
     # ========User Functions==========
 
     # TODO: part of Assignment 3.2:
-    def open(self, path, mode):
+    def open(self, path, mode, writeBuffer=0):
         """
         Return a File object corresponding to "path", opened for either
         reading, writing, creating or appending.
@@ -140,6 +391,7 @@ class FileSystem:
         https://docs.python.org/3/library/functions.html#open
         :param path:   path to the file we want to open
         :param mode:   "r", "w", or "a"
+        :param writeBuffer: collect small writes into this many bytes (see File)
         :return:       File object, or None if there is no such file (or it's a directory)
         """
         fileInode, fileParent = self.namei(path)
@@ -148,7 +400,23 @@ class FileSystem:
         if not fileInode.isFile():
             print("Error: file to read from is actually a directory")
             return None
-        return File(fileInode, fileParent)
+        return File(fileInode, fileParent, writeBuffer=writeBuffer)
+
+    def openBuffered(self, path, mode, bufferSize=io.DEFAULT_BUFFER_SIZE):
+        """
+        open, wrapped in an io.BufferedReader ("r") or io.BufferedWriter
+        ("w", or "a" to start at the end of the file), for streaming a file
+        through the io stack (shutil.copyfileobj, line iteration, ...)
+        :return: the buffered file, or None if open fails
+        """
+        file = self.open(path, mode)
+        if file is None:
+            return None
+        if mode == "r":
+            return io.BufferedReader(file, bufferSize)
+        if mode == "a":
+            file.seek(0, io.SEEK_END)
+        return io.BufferedWriter(file, bufferSize)
 
     def splitPathName(self,path):
         pathList = path.split("/")
@@ -167,7 +435,7 @@ class FileSystem:
         #print("|||dirInode: " + str(dirInode.inodeNum))
         #if(dirParent is not None):
             #print("parentInode:" + str(dirParent))
-        dir = Directory(dirInode, dirParent)
+        dir = self.getDirectory(dirInode, dirParent)
         #print("PrintDir inode: " + str(dir.inode.inodeNum))
         dirList = ""
         for key in dir.get_children():
@@ -191,7 +459,7 @@ class FileSystem:
         file.write(message.encode("utf-8"))
         file.seek(0)
 
-    def makeFSObj(self, path, newType):
+    def makeFSObj(self, path, newType, dirFormat=None):
         newPath, name = self.splitPathName(path)
         dirInode, dirParent = self.namei(newPath)
         #print("dirInode: " + str(dirInode.inodeNum))
@@ -202,22 +470,63 @@ class FileSystem:
         if not dirInode.isDirectory():
             print("Error: directory is actually a file")
             return
-        dir = Directory(dirInode, dirParent)
-        dirChildren = dir.get_children()
-        if dirChildren:
-            if name in dirChildren:
-                print("Error: file or directory  with that name already exists")
-                return
-        allocInode = self.inodeMap.inodeMap[self.inodeMap.allocateInode(newType)]
-        #print("alloc: " + str(allocInode.inodeNum))
-        dir.add_child(name, allocInode)
-        if newType == "d":
-            dir = Directory(allocInode, dir.inode)
-            dir.add_child(".", dir.inode)
-            dir.add_child("..", dir.parent)
-
-    def makeDir(self,path):
-        self.makeFSObj(path, "d")
+        dir = self.getDirectory(dirInode, dirParent)
+        with self.operation():  # a new directory is committed with its . and ..
+            with dirInode.lock.writing():  # nobody else takes the name meanwhile
+                if dir.lookup(name) is not None:
+                    print("Error: file or directory  with that name already exists")
+                    return
+                allocNum = self.inodeMap.allocateInode(newType)
+                if allocNum == -1:
+                    return
+                allocInode = self.inodeMap.inodeMap[allocNum]
+                #print("alloc: " + str(allocInode.inodeNum))
+                dir.add_child(name, allocInode)
+            if newType == "d":
+                dir = self.getDirectory(allocInode, dirInode, dirFormat)
+                dir.add_child(".", allocInode)
+                dir.add_child("..", dirInode)
+
+    def create_many(self, parent, names, newType, dirFormat=None):
+        """
+        Create many files or directories in one directory: the parent is
+        looked up and read once, the inodes are allocated together and the
+        parent is written once.
+        :param parent:  path of the directory to create them in (None for
+                        the current directory)
+        :param names:   names of the new entries; a name given twice is created once
+        :param newType: "f" or "d"
+        :return:        list of the new inode numbers, in the order of names. It is
+                        shorter than names when names repeat, when some already
+                        exist (they are left alone) or when the inodes run out.
+        """
+        dirInode, dirParent = self.namei(parent)
+        if dirInode is None:
+            return []
+        if not dirInode.isDirectory():
+            print("Error: directory is actually a file")
+            return []
+        dir = self.getDirectory(dirInode, dirParent)
+        with self.operation():
+            with dirInode.lock.writing():
+                if dir.isHashed():
+                    existing = set(name for name in dict.fromkeys(names) if dir.lookup(name) is not None)
+                else:
+                    existing = set(dir.get_children())
+                newNames = [name for name in dict.fromkeys(names) if name not in existing]
+                taken = [name for name in dict.fromkeys(names) if name in existing]
+                if taken:
+                    print("Error: file or directory  with that name already exists: " + ", ".join(taken))
+                inodeNums = self.inodeMap.allocateInodes(newType, len(newNames))
+                newInodes = [self.inodeMap.inodeMap[i] for i in inodeNums]
+                dir.add_children(dict(zip(newNames, newInodes)))
+            if newType == "d":
+                for newInode in newInodes:
+                    self.getDirectory(newInode, dirInode, dirFormat).add_children({".": newInode, "..": dirInode})
+        return inodeNums
+
+    def makeDir(self,path, dirFormat=None):
+        self.makeFSObj(path, "d", dirFormat)
 
     def makeFile(self,path):
         self.makeFSObj(path, "f")
@@ -229,7 +538,7 @@ class FileSystem:
         if not dirInode.isDirectory():
             print("Error: directory is actually a file")
             return
-        self.currentDir = Directory(dirInode, dirParent)
+        self.currentDir = self.getDirectory(dirInode, dirParent)
 
     def printBlockMap(self):
         self.blockMap.printBlockMap()
@@ -237,20 +546,746 @@ class FileSystem:
     def allocBlock(self):
         return self.blockMap.allocateBlock()
 
+    def allocExtent(self, n, near=None):
+        return self.blockMap.allocate_extent(n, near)
+
+    def markMetadata(self, blockNum, fresh=False):
+        """
+        a cached block of pointers or of a directory changed, see Journal
+        :param fresh: the block was allocated for this, nothing committed points at it yet
+        """
+        if self.journal is not None:
+            self.journal.note(blockNum, fresh)
+
     def freeBlock(self, blockNum):
-        self.blockMap.freeBlock(blockNum)
+        if self.journal is not None and self.journal.defersFree(blockNum):
+            self.blockCache.discard(blockNum)
+            return
+        if self.blockMap.freeBlock(blockNum):
+            self.blockCache.discard(blockNum)
 
     def printINodeMap(self):
         self.inodeMap.printInodeMap()
 
     def allocINode(self, typeName):
         try:
-            self.inodeMap.allocateInode(INodeType(ord(typeName)))
-        except ValueError:
+            INodeType(ord(typeName))
+        except (ValueError, TypeError):
             print("Error: alloc_inode - invalid state try O,f,d,s")
+            return
+        inodeNum = self.inodeMap.allocateInode(typeName)
+        if inodeNum != -1:
+            print("Allocated Inode at " + str(inodeNum) + " to state" + typeName + ".\n")
 
     def freeINode(self, inodeNum):
-        self.inodeMap.freeInode(inodeNum)
+        with self.operation():
+            inode = self.inodeMap.inodeMap[inodeNum]
+            if inode.flags != INodeType.FREE:
+                inode.truncate(0)
+            if self.inodeMap.freeInode(inodeNum):
+                self.directories.pop(inodeNum, None)
+                self.dentryCache.invalidateDir(inodeNum)
+
+
+class BlockCache:
+    """
+    The FileSystem's buffer cache: a bounded LRU map from block number to
+    (block, dirty). Its size is a byte budget, converted to a block count
+    with the master block's blockSize. When it is full, the least recently
+    used blocks are evicted, and the dirty ones among them are written back
+    to the mounted BlockDevice (in one vectored write) on the way out.
+    It is locked, so a Flusher can write blocks back from its own thread.
+    The lock is not held across device writes: blocks on their way to the
+    device stay in writingBack until they are written, so a lookup still
+    finds them, and writeLock keeps the writes themselves in order.
+    """
+
+    def __init__(self, parentFS, maxBytes=default_cachebytes):
+        self.parentFS = parentFS
+        self.maxBytes = maxBytes
+        self.blocks = OrderedDict()
+        self.dirtySince = OrderedDict()  # dirty block number -> when it got dirty, oldest first
+        self.lock = threading.RLock()
+        self.writeLock = threading.Lock()  # taken before lock, never while holding it
+        self.evicted = []  # (block number, block) of dirty victims of evict, to be written
+        self.writingBack = {}  # block number -> block, for blocks being written back
+        self.unsynced = False  # written back since writeBackUnpinned last looked, see Journal.commit
+        self.flusher = None  # woken when there is too much dirty data, see Flusher
+        self.fetches = {}  # block number -> Fetch, for the blocks being read from the device
+        self.hits = 0
+        self.misses = 0
+        self.mergedReads = 0  # misses that waited for another reader's Fetch
+        self.readAheads = 0
+        self.evictions = 0
+        self.writeBacks = 0
+
+    def capacity(self):
+        return max(1, self.maxBytes // self.parentFS.masterBlock.blockSize)
+
+    def __contains__(self, blockNum):
+        return blockNum in self.blocks or blockNum in self.writingBack
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def dirtyBytes(self):
+        return len(self.dirtySince) * self.parentFS.masterBlock.blockSize
+
+    def lookup(self, blockNum):
+        """
+        returns the cached block and marks it most recently used,
+        None (and a miss) if the block is not cached
+        """
+        with self.lock:
+            entry = self.blocks.get(blockNum)
+            if entry is None and blockNum in self.writingBack:
+                # evicted, but not written yet: it is still the latest
+                self.insert(blockNum, self.writingBack[blockNum], False)
+                entry = self.blocks[blockNum]
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.blocks.move_to_end(blockNum)
+            return entry[0]
+
+    def insert(self, blockNum, block, dirty):
+        """
+        caches block as the most recently used entry, evicting if over budget
+        (see writeEvicted). re-inserting a dirty block never makes it clean
+        """
+        with self.lock:
+            entry = self.blocks.get(blockNum)
+            if entry is not None and entry[1]:
+                dirty = True
+            self.blocks[blockNum] = (block, dirty)
+            self.blocks.move_to_end(blockNum)
+            if dirty:
+                self.setDirty(blockNum)
+            self.evict()
+
+    def markDirty(self, blockNum):
+        with self.lock:
+            block, dirty = self.blocks[blockNum]
+            self.blocks[blockNum] = (block, True)
+            self.setDirty(blockNum)
+
+    def setDirty(self, blockNum):
+        if blockNum not in self.dirtySince:
+            self.dirtySince[blockNum] = time.monotonic()
+            if self.flusher is not None and self.flusher.maxDirtyBytes is not None and \
+                    self.dirtyBytes() > self.flusher.maxDirtyBytes:
+                self.flusher.wake()
+
+    def evict(self):
+        """
+        evict the least recently used blocks while over budget, but none
+        that the Journal pins: metadata waits for its commit before it may
+        reach its place. The dirty victims are only queued; writeEvicted
+        writes them, once the lock is let go.
+        """
+        with self.lock:
+            journal = self.parentFS.journal
+            kept = 0
+            while len(self.blocks) > self.capacity() and kept < len(self.blocks):
+                blockNum, (block, dirty) = self.blocks.popitem(last=False)
+                if journal is not None and journal.pins(blockNum):
+                    self.blocks[blockNum] = (block, dirty)  # now the most recently used
+                    kept += 1
+                    continue
+                self.evictions += 1
+                if dirty:
+                    del self.dirtySince[blockNum]
+                    self.evicted.append((blockNum, block))
+                    self.writingBack[blockNum] = block
+
+    def writeEvicted(self):
+        """ write back the dirty blocks evict queued; not to be called holding the lock """
+        if self.evicted:
+            self.writeBack(self.parentFS.rBlockDev, [])
+
+    def flush(self, blockDev):
+        """ write every dirty block to blockDev, and mark them clean """
+        with self.lock:
+            blockNums = list(self.dirtySince)
+        self.writeBack(blockDev, blockNums)
+
+    def writeBackOld(self, maxAge=None, maxDirtyBytes=None):
+        """
+        write back the blocks that have been dirty for maxAge seconds or
+        more, and then the oldest others until at most half of maxDirtyBytes
+        is dirty, if more than maxDirtyBytes was
+        :return: how many blocks were written
+        """
+        with self.lock:
+            excess = 0
+            if maxDirtyBytes is not None and self.dirtyBytes() > maxDirtyBytes:
+                excess = len(self.dirtySince) - maxDirtyBytes // 2 // self.parentFS.masterBlock.blockSize
+            now = time.monotonic()
+            victims = []
+            for blockNum, since in self.dirtySince.items():
+                if len(victims) >= excess and (maxAge is None or now - since < maxAge):
+                    break  # the rest got dirty later still
+                victims.append(blockNum)
+            journal = self.parentFS.journal
+            if journal is not None:
+                # metadata that is not committed yet has to wait for the commit
+                victims = [blockNum for blockNum in victims if not journal.pins(blockNum)]
+        return self.writeBack(self.parentFS.rBlockDev, victims)
+
+    def writeBackUnpinned(self, journal):
+        """
+        write back the dirty blocks that journal does not pin
+        :return: True if anything was written back since the last call, by
+                 this call or by an eviction or Flusher, and may not be durable
+        """
+        self.writeBack(self.parentFS.rBlockDev, [])  # whatever evict queued
+        with self.lock:
+            blockNums = [b for b in self.dirtySince if not journal.pins(b)]
+        self.writeBack(self.parentFS.rBlockDev, blockNums)
+        with self.lock:
+            unsynced, self.unsynced = self.unsynced, False
+        return unsynced
+
+    def claimFetch(self, blockNum):
+        """
+        for a miss: the first to miss blockNum reads it, whoever misses it
+        while that read is going on waits for it (see awaitFetch)
+        :return: (the Fetch, True if the caller is to read the block and endFetch it)
+        """
+        with self.lock:
+            fetch = self.fetches.get(blockNum)
+            if fetch is not None:
+                fetch.waiters += 1
+                self.mergedReads += 1
+                return fetch, False
+            fetch = self.fetches[blockNum] = Fetch()
+            return fetch, True
+
+    def claimUncached(self, blockNum):
+        """
+        claimFetch for reads that bypass the cache: only claims blockNum
+        if it is neither cached nor being read, and never waits
+        :return: True if the caller is to read the block and endFetch it
+        """
+        with self.lock:
+            if blockNum in self.blocks or blockNum in self.fetches or blockNum in self.writingBack:
+                return False
+            self.fetches[blockNum] = Fetch()
+            return True
+
+    def endFetch(self, blockNum, block, cache=True, dirty=False):
+        """
+        hand a claimed block, just read, to whoever waits for it
+        :param block: the block, None if the read failed
+        :param cache: cache the block; if not, the waiters get a copy
+        :return:      the block as cached (a block cached meanwhile wins)
+        """
+        with self.lock:
+            fetch = self.fetches.pop(blockNum)
+            if block is not None and cache:
+                cached = self.peek(blockNum)
+                if cached is None:
+                    cached = block
+                    self.insert(blockNum, block, dirty)
+                elif dirty:
+                    self.markDirty(blockNum)
+                fetch.block = cached
+            elif block is not None and fetch.waiters:
+                fetch.block = bytearray(block)
+        fetch.done.set()
+        self.writeEvicted()
+        return fetch.block
+
+    def awaitFetch(self, blockNum, fetch, dirty=False):
+        """ wait for another reader's Fetch; returns the block, None if that read failed """
+        fetch.done.wait()
+        if fetch.block is None:
+            return None
+        with self.lock:
+            block = self.peek(blockNum)
+            if block is None:
+                block = fetch.block
+                self.insert(blockNum, block, dirty)
+            elif dirty:
+                self.markDirty(blockNum)
+        self.writeEvicted()
+        return block
+
+    def peek(self, blockNum):
+        """ the cached block, or None; not counted and not made recently used """
+        entry = self.blocks.get(blockNum)
+        return None if entry is None else entry[0]
+
+    def writeBack(self, blockDev, blockNums):
+        """
+        mark blockNums clean and write them to blockDev, along with whatever
+        evict queued, in one vectored write made without holding the lock
+        :return: how many blocks were written
+        """
+        with self.writeLock:
+            with self.lock:
+                victims = dict(self.evicted)
+                self.evicted = []
+                for blockNum in blockNums:
+                    if blockNum in self.dirtySince:
+                        block = self.blocks[blockNum][0]
+                        self.blocks[blockNum] = (block, False)
+                        del self.dirtySince[blockNum]
+                        victims[blockNum] = self.writingBack[blockNum] = block
+            try:
+                if victims:
+                    blockDev.write_blocks(list(victims), list(victims.values()), True)
+            except BaseException:
+                with self.lock:  # still dirty
+                    for blockNum, block in victims.items():
+                        if self.writingBack.get(blockNum) is block:
+                            del self.writingBack[blockNum]
+                            if blockNum in self.blocks:
+                                self.markDirty(blockNum)
+                            else:
+                                self.blocks[blockNum] = (block, True)
+                                self.setDirty(blockNum)
+                raise
+            with self.lock:
+                for blockNum, block in victims.items():
+                    if self.writingBack.get(blockNum) is block:
+                        del self.writingBack[blockNum]
+                self.writeBacks += len(victims)
+                if victims:
+                    self.unsynced = True
+            return len(victims)
+
+    def discard(self, blockNum):
+        """ forget a block, without writing it back (it has been freed) """
+        with self.lock:
+            self.blocks.pop(blockNum, None)
+            self.dirtySince.pop(blockNum, None)
+            if self.writingBack.pop(blockNum, None) is not None:
+                self.evicted = [victim for victim in self.evicted if victim[0] != blockNum]
+
+    def clear(self):
+        with self.lock:
+            self.blocks.clear()
+            self.dirtySince.clear()
+            self.evicted = []
+            self.writingBack.clear()
+
+    def stats(self):
+        return ("cache: {} of {} blocks ({} dirty), {} hits, {} misses ({} merged), {} read ahead, {} evictions, "
+                "{} write-backs").format(
+            len(self.blocks), self.capacity(), len(self.dirtySince), self.hits, self.misses, self.mergedReads,
+            self.readAheads, self.evictions, self.writeBacks)
+
+
+class Fetch:
+    """
+    A device read of one block that is going on, see BlockCache.claimFetch.
+    Threads that miss the block meanwhile wait for done, then take block.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.block = None
+        self.waiters = 0
+
+
+class Flusher(threading.Thread):
+    """
+    Background write-back: every interval seconds (or sooner, when the
+    BlockCache has more than maxDirtyBytes dirty) it writes back the cached
+    blocks that have been dirty for maxAge seconds, and enough of the
+    oldest others to bring the dirty data down to half of maxDirtyBytes.
+    Started and stopped by FileSystem.startFlusher / stopFlusher.
+    """
+
+    def __init__(self, blockCache, maxAge=None, maxDirtyBytes=None, interval=default_flushinterval):
+        super(Flusher, self).__init__(name="Flusher", daemon=True)
+        self.blockCache = blockCache
+        self.maxAge = maxAge
+        self.maxDirtyBytes = maxDirtyBytes
+        self.interval = interval
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.passes = 0
+
+    def wake(self):
+        self.wakeup.set()
+
+    def run(self):
+        while not self.stopping.is_set():
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            if self.stopping.is_set():
+                return
+            self.blockCache.writeBackOld(self.maxAge, self.maxDirtyBytes)
+            self.passes += 1
+
+    def stop(self):
+        self.stopping.set()
+        self.wakeup.set()
+        self.join()
+
+
+class Journal:
+    """
+    Write-ahead journal of the metadata (format_journal and later): the
+    master block, block map, inode bitmap and inode table, and the cached
+    blocks of pointers and of directories (see FileSystem.markMetadata).
+
+    commit logs every change since the last commit as one transaction of
+    byte-range patch records, written with one sequential write and
+    fsynced, after the dirty data blocks (so committed metadata never
+    points at unwritten data). It runs between operations (see
+    FileSystem.operation), so a transaction never holds half of one.
+    Blocks of pointers or of a directory allocated since the last commit
+    are not logged: nothing committed points at them, so they are written
+    with the data. The other metadata reaches its place later: the cache
+    keeps (pins) a changed block until it is committed, then may write it
+    back like any other, and checkpoint writes all of it and empties the
+    journal. A block freed while the journal may hold records for it
+    stays allocated until the next checkpoint, so replay can never patch
+    it after it is reused.
+
+    Block 0 of the region holds the sequence number of the first
+    transaction, which starts at block 1. A transaction is a header (with
+    a crc32 of its records), its records (block, offset, length, bytes)
+    and padding to a whole block; the next one follows it. mount replays
+    transactions in sequence until one is missing or fails its crc32.
+    """
+    header_format = "=4sQ"         # magic, sequence of the first transaction
+    magic = b"WALJ"
+    txn_format = "=4sQIII"         # magic, sequence, record count, record bytes, crc32
+    txn_magic = b"WTXN"
+    record_format = "=iHH"         # block, offset, length (followed by the bytes)
+
+    def __init__(self, parentFS):
+        self.parentFS = parentFS
+        self.masterBlock = parentFS.masterBlock
+        self.sequence = 1      # of the next transaction
+        self.firstSequence = 1  # of the first one in the journal
+        self.nextBlock = 1     # where it goes, relative to the journal
+        self.metaBlocks = {}   # metadata block -> contents as last committed (None if not yet)
+        self.pending = set()   # metadata blocks changed since the last commit
+        self.fresh = set()     # those of them allocated since the last commit
+        self.inodeShadow = {}  # inode number -> packed inode as last committed
+        self.masterShadow = None
+        self.blockMapShadow = None
+        self.inodeBitmapShadow = None
+        self.deferredFrees = []
+        self.commits = 0
+        self.checkpoints = 0
+
+    def start(self):
+        """ take the just mounted metadata as committed """
+        self.masterShadow = bytes(self.masterBlock.pack())
+        self.blockMapShadow = self.parentFS.blockMap.blockMap.bits.copy()
+        self.inodeBitmapShadow = self.parentFS.inodeMap.inodeBitmap.bits.copy()
+
+    def note(self, blockNum, fresh=False):
+        with self.parentFS.blockCache.lock:  # which guards the journal's own state too
+            self.metaBlocks.setdefault(blockNum, None)
+            self.pending.add(blockNum)
+            if fresh:
+                self.fresh.add(blockNum)
+
+    def pins(self, blockNum):
+        """ whether blockNum holds changes that must not reach its place before the next commit """
+        return blockNum in self.pending and blockNum not in self.fresh
+
+    def needsCommit(self):
+        """
+        whether enough waits to be committed that it should be now: a
+        quarter of the journal (roughly, as whole blocks and inodes), or
+        pinned blocks for half of the cache
+        """
+        with self.parentFS.blockCache.lock:
+            blockSize = self.masterBlock.blockSize
+            inodes = max(0, len(self.parentFS.inodeMap.dirtyInodes) - len(self.inodeShadow))
+            size = len(self.pending) * blockSize + inodes * (INode.Inode_Size + struct.calcsize(Journal.record_format))
+            return size > self.masterBlock.journalBlockCount * blockSize // 4 or \
+                len(self.pending) - len(self.fresh) > self.parentFS.blockCache.capacity() // 2
+
+    def defersFree(self, blockNum):
+        """ True if the journal holds records for blockNum; it is freed at the next checkpoint """
+        with self.parentFS.blockCache.lock:
+            self.pending.discard(blockNum)
+            self.fresh.discard(blockNum)
+            if self.metaBlocks.get(blockNum) is None:
+                self.metaBlocks.pop(blockNum, None)  # never committed, nothing to replay
+                return False
+            self.deferredFrees.append(blockNum)
+            return True
+
+    @staticmethod
+    def diff(address, blockSize, old, new):
+        """
+        patch records turning old into new, two byte strings laid over
+        consecutive blocks from address; changes less than a record header
+        apart share a record
+        """
+        changed = np.flatnonzero(np.frombuffer(old, dtype=np.uint8) != np.frombuffer(new, dtype=np.uint8))
+        records = []
+        gap = struct.calcsize(Journal.record_format)
+        i = 0
+        while i < len(changed):
+            start = end = int(changed[i])
+            block = start // blockSize
+            i += 1
+            while i < len(changed) and changed[i] - end <= gap and changed[i] // blockSize == block:
+                end = int(changed[i])
+                i += 1
+            records.append((address + block, start % blockSize, bytes(new[start:end + 1])))
+        return records
+
+    def gather(self):
+        """ patch records for everything that changed since the last commit """
+        blockSize = self.masterBlock.blockSize
+        records = Journal.diff(0, blockSize, self.masterShadow, bytes(self.masterBlock.pack()))
+        records += Journal.diff(self.masterBlock.blockMapAddress, blockSize,
+                                self.blockMapShadow, self.parentFS.blockMap.blockMap.bits)
+        records += Journal.diff(self.masterBlock.inodeBitmapAddress, blockSize,
+                                self.inodeBitmapShadow, self.parentFS.inodeMap.inodeBitmap.bits)
+        for inodeNum, inode in sorted(self.parentFS.inodeMap.dirtyInodes.items()):
+            inodeBytes = bytes(inode.toBytes())
+            if self.inodeShadow.get(inodeNum) != inodeBytes:
+                blockNum, slot = self.masterBlock.inodeLocation(inodeNum)
+                records.append((blockNum, slot, inodeBytes))
+        for blockNum in sorted(self.pending - self.fresh):
+            block = self.parentFS.blockCache.peek(blockNum)
+            if block is None:
+                continue
+            if self.metaBlocks[blockNum] is None:
+                records.append((blockNum, 0, bytes(block)))
+            else:
+                records += Journal.diff(blockNum, blockSize, self.metaBlocks[blockNum], block)
+        return records
+
+    def commit(self):
+        """
+        group commit: write back the dirty data and fsync it, then log
+        every metadata change since the last commit as one transaction, and
+        fsync again. Called
+        by FileSystem.sync, between operations, so only gathering the
+        records needs the metadata locked.
+        :return: number of patch records committed
+        """
+        blockDev = self.parentFS.rBlockDev
+        blockSize = self.masterBlock.blockSize
+        with self.parentFS.metadataLocked():
+            records = self.gather()
+        if self.parentFS.blockCache.writeBackUnpinned(self) and records:
+            blockDev.sync()  # the data is durable before any record that points at it
+        if not records:
+            blockDev.sync()
+            with self.parentFS.blockCache.lock:
+                self.fresh.clear()
+            return 0
+        payload = b"".join(struct.pack(Journal.record_format, blockNum, offset, len(data)) + data
+                           for blockNum, offset, data in records)
+        txn = bytearray(struct.pack(Journal.txn_format, Journal.txn_magic, self.sequence,
+                                    len(records), len(payload), zlib.crc32(payload)))
+        txn += payload
+        blockCount = cielDiv(len(txn), blockSize)
+        frees = []
+        if self.nextBlock + blockCount > self.masterBlock.journalBlockCount:
+            # no room left: put what is committed in place first, then log this from the start
+            frees = self.checkpointLog()
+        if 1 + blockCount > self.masterBlock.journalBlockCount:
+            print("Error: Journal.commit(): a transaction of " + str(blockCount) +
+                  " blocks does not fit in the journal, writing it in place")
+            self.deferredFrees += frees
+            self.checkpoint()
+            return len(records)
+        txn += bytes(blockCount * blockSize - len(txn))
+        blockDev.write_blocks([self.masterBlock.journalAddress + self.nextBlock + i for i in range(blockCount)],
+                              [txn[i * blockSize:(i + 1) * blockSize] for i in range(blockCount)])
+        blockDev.sync()
+        with self.parentFS.metadataLocked():
+            self.sequence += 1
+            self.nextBlock += blockCount
+            self.commits += 1
+            self.committed()
+            for inodeNum, inode in self.parentFS.inodeMap.dirtyInodes.items():
+                self.inodeShadow[inodeNum] = bytes(inode.toBytes())
+            for blockNum in self.pending:
+                block = self.parentFS.blockCache.peek(blockNum)
+                if block is not None:
+                    self.metaBlocks[blockNum] = bytes(block)
+            self.pending.clear()
+            self.fresh.clear()
+            for blockNum in frees:
+                self.metaBlocks.pop(blockNum, None)  # no records left to replay over it
+                self.parentFS.freeBlock(blockNum)  # a change of its own, for the next commit
+        if self.nextBlock > self.masterBlock.journalBlockCount // 2:
+            self.checkpoint()
+        return len(records)
+
+    def committed(self):
+        """ the master block and bitmaps as they are now are committed """
+        self.masterShadow = bytes(self.masterBlock.pack())
+        self.blockMapShadow = self.parentFS.blockMap.blockMap.bits.copy()
+        self.inodeBitmapShadow = self.parentFS.inodeMap.inodeBitmap.bits.copy()
+
+    def checkpoint(self):
+        """ write all the metadata in place, then empty the journal; between operations, like commit """
+        blockDev = self.parentFS.rBlockDev
+        with self.parentFS.blockCache.lock:
+            self.pending.clear()
+            self.fresh.clear()
+        self.parentFS.writeInPlace()
+        self.nextBlock = 1
+        self.writeHeader(blockDev)
+        blockDev.sync()
+        with self.parentFS.metadataLocked():
+            self.checkpoints += 1
+            self.metaBlocks.clear()
+            self.inodeShadow.clear()
+            self.committed()
+            frees, self.deferredFrees = self.deferredFrees, []
+            for blockNum in frees:
+                self.parentFS.freeBlock(blockNum)  # changes of their own, for the next commit
+
+    def checkpointLog(self):
+        """
+        apply the transactions in the journal in place, read back from the
+        journal itself, then empty it. Unlike checkpoint, nothing that is
+        not committed reaches the device.
+        :return: the blocks whose free was deferred, which may be freed
+                 once the next transaction is committed
+        """
+        blockDev = self.parentFS.rBlockDev
+        self.applyLog(blockDev, self.firstSequence)
+        self.nextBlock = 1
+        self.writeHeader(blockDev)
+        blockDev.sync()
+        with self.parentFS.blockCache.lock:
+            self.checkpoints += 1
+            frees, self.deferredFrees = self.deferredFrees, []
+        return frees
+
+    def writeHeader(self, blockDev):
+        header = bytearray(self.masterBlock.blockSize)
+        struct.pack_into(Journal.header_format, header, 0, Journal.magic, self.sequence)
+        blockDev.write_block(self.masterBlock.journalAddress, header)
+        self.firstSequence = self.sequence
+
+    def replay(self, blockDev):
+        """
+        apply the committed transactions to the device, then empty the journal
+        :return: number of transactions replayed
+        """
+        buff = bytearray(self.masterBlock.blockSize)
+        blockDev.read_block(self.masterBlock.journalAddress, buff)
+        (magic, sequence) = struct.unpack_from(Journal.header_format, buff)
+        if magic != Journal.magic:
+            print("Error: Journal.replay(): no journal header, starting a new journal")
+            self.sequence = 1
+            self.writeHeader(blockDev)
+            return 0
+        self.sequence, replayed = self.applyLog(blockDev, sequence)
+        self.firstSequence = self.sequence
+        self.nextBlock = 1
+        if replayed:
+            self.writeHeader(blockDev)
+            blockDev.sync()
+        return replayed
+
+    def applyLog(self, blockDev, sequence):
+        """
+        patch the device with the transactions in the journal, in sequence
+        from the first one, until one is missing or fails its crc32
+        :param sequence: that of the first transaction
+        :return:         (sequence after the last one applied, number applied)
+        """
+        blockSize = self.masterBlock.blockSize
+        journalAddress = self.masterBlock.journalAddress
+        txnSize = struct.calcsize(Journal.txn_format)
+        recordSize = struct.calcsize(Journal.record_format)
+        patched = {}  # block -> its patched contents
+        applied = 0
+        at = 1
+        while at < self.masterBlock.journalBlockCount:
+            first = bytearray(blockSize)
+            blockDev.read_block(journalAddress + at, first)
+            (magic, txnSequence, recordCount, length, crc) = struct.unpack_from(Journal.txn_format, first)
+            blockCount = cielDiv(txnSize + length, blockSize)
+            if magic != Journal.txn_magic or txnSequence != sequence or \
+                    at + blockCount > self.masterBlock.journalBlockCount:
+                break
+            rest = [bytearray(blockSize) for i in range(blockCount - 1)]
+            blockDev.read_blocks([journalAddress + at + 1 + i for i in range(len(rest))], rest)
+            payload = bytes(b"".join([first] + rest)[txnSize:txnSize + length])
+            if zlib.crc32(payload) != crc:
+                break  # torn: never committed
+            offsetInPayload = 0
+            for r in range(recordCount):
+                (blockNum, offset, count) = struct.unpack_from(Journal.record_format, payload, offsetInPayload)
+                offsetInPayload += recordSize
+                if blockNum not in patched:
+                    patched[blockNum] = bytearray(blockSize)
+                    blockDev.read_block(blockNum, patched[blockNum])
+                patched[blockNum][offset:offset + count] = payload[offsetInPayload:offsetInPayload + count]
+                offsetInPayload += count
+            at += blockCount
+            sequence += 1
+            applied += 1
+        if patched:
+            blockDev.write_blocks(sorted(patched), [patched[b] for b in sorted(patched)])
+            blockDev.sync()
+        return sequence, applied
+
+
+class DentryCache:
+    """
+    Bounded LRU map from (parent directory inode number, name) to the child's
+    inode number, used by namei so resolving a path does not re-read every
+    directory on it. A name that is known not to exist is cached as None.
+    Whatever changes a directory must invalidate its entries.
+    """
+    MISS = object()  # lookup result when nothing is cached for the name
+    default_size = 4096
+
+    def __init__(self, maxEntries=default_size):
+        self.maxEntries = maxEntries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, parentNum, name):
+        """
+        returns the child inode number, None for a cached negative entry,
+        or DentryCache.MISS
+        """
+        with self.lock:
+            key = (parentNum, name)
+            if key not in self.entries:
+                self.misses += 1
+                return DentryCache.MISS
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def insert(self, parentNum, name, childNum):
+        with self.lock:
+            self.entries[(parentNum, name)] = childNum
+            self.entries.move_to_end((parentNum, name))
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, parentNum, name):
+        with self.lock:
+            self.entries.pop((parentNum, name), None)
+
+    def invalidateDir(self, parentNum):
+        """ drop every entry of a directory, e.g. after it is removed or rewritten """
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == parentNum]:
+                del self.entries[key]
 
 
 class MasterBlock:
@@ -271,7 +1306,9 @@ class MasterBlock:
             blockmapaddress=default_blockmapaddress,
             inodemapaddress=default_inodemapaddress,
             rootdiraddress=default_rootdiraddr,
-            flag=default_flags
+            flag=default_flags,
+            formatversion=default_formatversion,
+            dirformat=default_dirformat
     ):
         self.parentFS = pFS
         self.magicNumber = magicnumber
@@ -280,12 +1317,48 @@ class MasterBlock:
         self.inodeCount = int(inodecount)
         self.blockMapAddress = blockmapaddress
         self.flags = flag
-        self.blockMapBlockCount = cielDiv(cielDiv(self.blockCount, 8), self.blockSize)
-        self.inodeMapAddress = self.blockMapAddress + self.blockMapBlockCount
+        self.formatVersion = formatversion
+        self.dirFormat = dirformat
+        self.computeLayout()
+        self.inodeMapAddress = self.inodeBitmapAddress + self.inodeBitmapBlockCount
         self.rootDirAddress = 0
+        self.dirty = True  # a new master block has never been written
+
+    def computeLayout(self):
+        """
+        derive the sizes of the on-disk regions from the packed fields
+        """
+        self.blockMapBlockCount = cielDiv(cielDiv(self.blockCount, 8), self.blockSize)
+        if self.formatVersion >= format_packed_inodes:
+            self.inodeSlotSize = INode.Inode_Size
+        else:
+            self.inodeSlotSize = self.blockSize
+        self.inodesPerBlock = self.blockSize // self.inodeSlotSize
+        self.inodeBlockCount = cielDiv(self.inodeCount, self.inodesPerBlock)
+        self.inodeBitmapAddress = self.blockMapAddress + self.blockMapBlockCount
+        if self.formatVersion >= format_inode_bitmap:
+            self.inodeBitmapBlockCount = cielDiv(cielDiv(self.inodeCount, 8), self.blockSize)
+        else:
+            self.inodeBitmapBlockCount = 0
+        self.journalAddress = self.inodeBitmapAddress + self.inodeBitmapBlockCount + self.inodeBlockCount
+        if self.formatVersion >= format_journal:
+            # room for a transaction that rewrites the bitmaps and the whole
+            # inode table, twice over for record headers, besides the rest
+            self.journalBlockCount = min(max(self.blockCount // 32, 16), 1024) + \
+                2 * (1 + self.blockMapBlockCount + self.inodeBitmapBlockCount + self.inodeBlockCount)
+        else:
+            self.journalBlockCount = 0
+
+    def inodeLocation(self, inodeID):
+        """
+        returns (block number, byte offset in that block) of an inode's slot
+        in the inode table
+        """
+        return (self.inodeMapAddress + inodeID // self.inodesPerBlock,
+                (inodeID % self.inodesPerBlock) * self.inodeSlotSize)
 
     def pack(self):
-        return bytearray(struct.pack("=ihihiiic",
+        return bytearray(struct.pack("=ihihiiicbb",
                                      self.magicNumber,  # 32 bits
                                      self.blockSize,  # 16 bits
                                      self.blockCount,  # 32 bits
@@ -293,10 +1366,14 @@ class MasterBlock:
                                      self.blockMapAddress,  # 32 bits
                                      self.inodeMapAddress,  # 32 bits
                                      self.rootDirAddress,  # 32 bits
-                                     bytes(self.flags, "utf8")))  # 8 bits, char format
+                                     bytes(self.flags, "utf8"),  # 8 bits, char format
+                                     self.formatVersion,  # 8 bits
+                                     self.dirFormat))  # 8 bits
 
     def unpack(self, blockDev):
-        # 0-24 are the 25 bytes of the master blcok
+        # 0-26 are the 27 bytes of the master blcok; images from before the
+        # format version existed have 0 (format_legacy, dir_format_text)
+        # padding bytes at 25 and 26
         readBArray = bytearray(self.blockSize)
         blockDev.read_block(0, readBArray)
         (self.magicNumber,
@@ -306,9 +1383,116 @@ class MasterBlock:
          self.blockMapAddress,
          self.inodeMapAddress,
          self.rootDirAddress,
-         self.flags) = struct.unpack("=ihihiiic", readBArray[:25])
+         self.flags,
+         self.formatVersion,
+         self.dirFormat) = struct.unpack("=ihihiiicbb", readBArray[:27])
         # decode from utf8 encoding to python string
         self.flags = self.flags.decode("utf8")
+        self.computeLayout()
+        self.dirty = False
+
+
+class Bitmap:
+    """
+    A fixed number of bits kept packed the way they are stored on disk
+    (np.packbits order: bit i is the (7 - i % 8)th bit of byte i // 8).
+    Indexing reads and writes single bits like the list of bools it
+    replaces, and keeps a count of the set bits. findClear searches for
+    a clear bit a window of bytes at a time with numpy.
+    """
+    search_window = 512  # bytes compared per numpy call in findClear
+
+    def __init__(self, count, data=None):
+        self.count = count
+        self.bits = np.zeros(cielDiv(count, 8), dtype=np.uint8)
+        if data is not None:
+            data = np.frombuffer(data, dtype=np.uint8)[:len(self.bits)]
+            self.bits[:len(data)] = data
+            if count % 8:
+                # bits past the end of the map are never used
+                self.bits[-1] &= np.uint8((0xFF << (8 - count % 8)) & 0xFF)
+        self.setCount = int(np.unpackbits(self.bits).sum())
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError("bitmap index out of range")
+        return bool(self.bits[i >> 3] & (0x80 >> (i & 7)))
+
+    def __setitem__(self, i, value):
+        if not 0 <= i < self.count:
+            raise IndexError("bitmap index out of range")
+        mask = 0x80 >> (i & 7)
+        byte = int(self.bits[i >> 3])
+        if value and not byte & mask:
+            self.bits[i >> 3] = byte | mask
+            self.setCount += 1
+        elif not value and byte & mask:
+            self.bits[i >> 3] = byte & ~mask
+            self.setCount -= 1
+
+    def findClear(self, start=0, end=None):
+        """
+        returns the index of the first clear bit in [start, end), -1 if none
+        """
+        if end is None or end > self.count:
+            end = self.count
+        i = start
+        while i < end:
+            firstByte = i >> 3
+            lastByte = min((end - 1) >> 3, firstByte + Bitmap.search_window - 1)
+            window = self.bits[firstByte:lastByte + 1]
+            for byteIndex in np.flatnonzero(window != 0xFF)[:2]:
+                byte = int(window[byteIndex])
+                for bit in range(8):
+                    found = ((firstByte + int(byteIndex)) << 3) + bit
+                    if found >= end:
+                        return -1
+                    if found >= i and not byte & (0x80 >> bit):
+                        return found
+            i = (lastByte + 1) << 3
+        return -1
+
+    def findClearRun(self, n, start=0, end=None):
+        """
+        returns (index, length) of the first run of n clear bits in
+        [start, end). If there is no run that long, the longest run seen
+        (length < n) is returned instead, and (-1, 0) if no bit is clear.
+        """
+        if end is None or end > self.count:
+            end = self.count
+        best = (-1, 0)
+        windowBits = max(8 * Bitmap.search_window, 64 * n)
+        i = start
+        while i < end:
+            i = self.findClear(i, end)
+            if i == -1:
+                break
+            # runs are found from the packed bits a window at a time; the
+            # next window starts n-1 bits back so no run of n is missed
+            windowEnd = min(end, i + windowBits)
+            firstByte = i >> 3
+            bits = np.unpackbits(self.bits[firstByte:cielDiv(windowEnd, 8)])
+            bits = bits[i - (firstByte << 3):windowEnd - (firstByte << 3)]
+            edges = np.diff(np.concatenate(([1], bits, [1])).astype(np.int8))
+            runStarts = np.flatnonzero(edges == -1)
+            runLengths = np.flatnonzero(edges == 1) - runStarts
+            longEnough = np.flatnonzero(runLengths >= n)
+            if len(longEnough):
+                return (i + int(runStarts[longEnough[0]]), n)
+            longest = int(np.argmax(runLengths))
+            if runLengths[longest] > best[1]:
+                best = (i + int(runStarts[longest]), int(runLengths[longest]))
+            if windowEnd == end:
+                break
+            i = max(i + 1, windowEnd - (n - 1))
+        return best
+
+    def toBytes(self, start=0, end=None):
+        """ the packed bytes [start, end) of the bitmap """
+        return bytearray(self.bits[start:end].tobytes())
 
 
 class BlockMap:
@@ -316,41 +1500,82 @@ class BlockMap:
     def __init__(self, parentFS):
         self.parentFS = parentFS
         self.masterBlock = self.parentFS.masterBlock
-        self.blockMap = [False] * self.masterBlock.blockCount
+        self.blockMap = Bitmap(self.masterBlock.blockCount)
+        self.nextFree = 0  # rotating hint: allocation searches from here, then wraps
+        self.dirtyRegions = set()  # indexes of block map blocks changed since the last sync
+        self.lock = threading.RLock()  # allocating threads take turns
+
+    def freeCount(self):
+        return self.masterBlock.blockCount - self.blockMap.setCount
+
+    def markDirty(self, blockID):
+        self.dirtyRegions.add(blockID // (8 * self.masterBlock.blockSize))
 
     def setBlock(self, blockID, newState):
         """
         attempts to set a block in the blockmap to the sepecified state,
         prints error if attempt fails
         """
-        if blockID > self.masterBlock.blockCount:
-            print("Error: BlockMap.setBlock(): blockID greater than file system's blockCount.")
-            return False
-        if self.blockMap[blockID] is True:
-            if newState is False:
-                self.blockMap[blockID] = False
-                return True
-            else:
-                print("Error: BlockMap.setBlock(): A Block already exists at specified blockID.")
+        with self.lock:
+            if blockID >= self.masterBlock.blockCount:
+                print("Error: BlockMap.setBlock(): blockID greater than file system's blockCount.")
                 return False
-        self.blockMap[blockID] = newState
-        return True
+            if self.blockMap[blockID] is True:
+                if newState is False:
+                    self.blockMap[blockID] = False
+                    self.markDirty(blockID)
+                    return True
+                else:
+                    print("Error: BlockMap.setBlock(): A Block already exists at specified blockID.")
+                    return False
+            self.blockMap[blockID] = newState
+            self.markDirty(blockID)
+            return True
 
     def allocateBlock(self):
         """
         returns block number(i) of allocated block if successful, -1 otherwise
-        the allocated block is always the first open one in the blockmap.
+        the allocated block is the first open one at or after the nextFree
+        hint, wrapping around to the start of the blockmap.
         """
-        for i in range(0, self.masterBlock.blockCount):
-            if not self.blockMap[i]:
-                if self.setBlock(i, True):
-                    #print("Allocated Block " + str(i) + ".\n")
-                    return i
-                else:
-                    print("Error BlockMap.allocateBlock()")
-                    return -1
-        print("Error BlockMap.allocateBlock(): BlockMap full")
-        return -1
+        with self.lock:
+            if self.freeCount() == 0:
+                print("Error BlockMap.allocateBlock(): BlockMap full")
+                return -1
+            i = self.blockMap.findClear(self.nextFree)
+            if i == -1:
+                i = self.blockMap.findClear(0, self.nextFree)
+            if not self.setBlock(i, True):
+                print("Error BlockMap.allocateBlock()")
+                return -1
+            #print("Allocated Block " + str(i) + ".\n")
+            self.nextFree = (i + 1) % self.masterBlock.blockCount
+            return i
+
+    def allocate_extent(self, n, near=None):
+        """
+        allocates a contiguous run of up to n blocks: the first run of n
+        free blocks at or after near (default: the nextFree hint), wrapping
+        around to the start of the blockmap. If no run of n is free, the
+        longest free run found is allocated instead.
+        returns (first block, block count), (-1, 0) if the blockmap is full
+        """
+        with self.lock:
+            if self.freeCount() == 0:
+                print("Error BlockMap.allocate_extent(): BlockMap full")
+                return -1, 0
+            if near is None or not 0 <= near < self.masterBlock.blockCount:
+                near = self.nextFree
+            start, count = self.blockMap.findClearRun(n, near)
+            if count < n:
+                wrapStart, wrapCount = self.blockMap.findClearRun(n, 0, near + n - 1)
+                if wrapCount > count:
+                    start, count = wrapStart, wrapCount
+            for i in range(start, start + count):
+                self.blockMap[i] = True
+                self.markDirty(i)
+            self.nextFree = (start + count) % self.masterBlock.blockCount
+            return start, count
 
     def freeBlock(self, blockID):
         if not self.setBlock(blockID, False):
@@ -377,82 +1602,215 @@ class BlockMap:
 
     def pack(self, blockDev):
         """
-        since 8 block map entries are being stored per byte, the range
-        is set to end at an eigth the total block count since i represents
-        bytes to be written.
+        the block map is kept packed 8 entries per byte, so its bytes are
+        written out as they are, a block at a time
         """
-        blockMapBytes = bytearray(np.packbits(self.blockMap))
-        # write to block [1,(blockCount//8)//blockSize]
-        for i in range(0, self.masterBlock.blockCount // 8, self.masterBlock.blockSize):
-            blockDev.write_block(1 + i // self.masterBlock.blockSize,
-                                 blockMapBytes[i:i + self.masterBlock.blockSize - 1], True)
+        blockSize = self.masterBlock.blockSize
+        # write to block [1,(blockCount//8)//blockSize] in one vectored write
+        blockNums = [self.masterBlock.blockMapAddress + r for r in range(self.masterBlock.blockMapBlockCount)]
+        buffs = [self.blockMap.toBytes(r * blockSize, (r + 1) * blockSize)
+                 for r in range(self.masterBlock.blockMapBlockCount)]
+        blockDev.write_blocks(blockNums, buffs, True)
+        self.dirtyRegions.clear()
         return
 
+    def sync(self, blockDev):
+        """
+        write only the blocks of the block map that changed since the last sync
+        """
+        blockSize = self.masterBlock.blockSize
+        regions = sorted(self.dirtyRegions)
+        buffs = [self.blockMap.toBytes(r * blockSize, (r + 1) * blockSize) for r in regions]
+        blockDev.write_blocks([self.masterBlock.blockMapAddress + r for r in regions], buffs, True)
+        self.dirtyRegions.clear()
+
     def unpack(self, blockDev):
         """
         on unpack (as part of unmount) we must update our masterblock reference and inital blockmap size
 
-        we read and unpack a block of the block map at a time. For each block from memory
-        we free the blocksize*8 bools into the blockmap until the maxium block map index is reached
-
-        if we run out of stored blocks before filling the block map, we print an error
+        we read every block of the block map with one vectored read, the
+        packed bytes become the bitmap as they are
         """
         self.masterBlock = self.parentFS.masterBlock
-        self.blockMap = [False] * self.masterBlock.blockCount
-        blockMapBuffer = bytearray(self.masterBlock.blockSize)
-        for i in range(0, self.masterBlock.blockCount // 8, self.masterBlock.blockSize):
-            blockDev.read_block(1 + i // self.masterBlock.blockSize, blockMapBuffer)
-            blockMapValues = np.unpackbits(blockMapBuffer)
-            for x in range(i * 8, (i + self.masterBlock.blockSize) * 8, 1):
-                if x >= self.masterBlock.blockCount:
-                    return
-                self.blockMap[x] = blockMapValues[x]
-        print("BlockMap:unpack:Error - Block map not filled from memory")
+        blockSize = self.masterBlock.blockSize
+        blockNums = [self.masterBlock.blockMapAddress + i for i in range(self.masterBlock.blockMapBlockCount)]
+        buffs = [bytearray(blockSize) for b in blockNums]
+        blockDev.read_blocks(blockNums, buffs)
+        if len(blockNums) * blockSize * 8 < self.masterBlock.blockCount:
+            print("BlockMap:unpack:Error - Block map not filled from memory")
+        self.blockMap = Bitmap(self.masterBlock.blockCount, b"".join(buffs))
+        self.nextFree = 0
+        self.dirtyRegions.clear()
+
+
+class InodeTable:
+    """
+    Stands in for InodeMap's list of INodes when inodes are loaded lazily:
+    inodeTable[i] reads and decodes inode i from the device the first time it
+    is asked for. Up to cacheSize recently used inodes are kept (all of them
+    if cacheSize is None); beyond that an inode is only kept while somebody
+    still holds it, or while it is dirty (see InodeMap.dirtyInodes), so each
+    inode number always maps to a single INode object.
+    """
 
+    def __init__(self, inodeMap, cacheSize=None):
+        self.inodeMap = inodeMap
+        self.cacheSize = cacheSize
+        self.recent = OrderedDict()
+        self.live = weakref.WeakValueDictionary()
+        self.loads = 0
+
+    def __len__(self):
+        return self.inodeMap.masterBlock.inodeCount
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, inodeID):
+        if isinstance(inodeID, slice):
+            return [self[i] for i in range(*inodeID.indices(len(self)))]
+        if inodeID < 0:
+            inodeID += len(self)
+        if not 0 <= inodeID < len(self):
+            raise IndexError("inode number out of range")
+        with self.inodeMap.lock:  # so two threads cannot load one inode twice
+            inode = self.recent.get(inodeID)
+            if inode is None:
+                inode = self.inodeMap.dirtyInodes.get(inodeID)
+            if inode is None:
+                inode = self.live.get(inodeID)
+            if inode is None:
+                inode = self.inodeMap.loadInode(inodeID)
+                self.live[inodeID] = inode
+                self.loads += 1
+            self.recent[inodeID] = inode
+            self.recent.move_to_end(inodeID)
+            if self.cacheSize is not None:
+                while len(self.recent) > self.cacheSize:
+                    self.recent.popitem(last=False)
+            return inode
 
 
 class InodeMap:
 
-    def __init__(self, parentFS):
+    def __init__(self, parentFS, lazy=False, cacheSize=None):
+        """
+        :param lazy:      load inodes from the device on first use (see
+                          InodeTable) instead of all of them in unpack
+        :param cacheSize: with lazy, how many unused inodes to keep loaded
+        """
         self.parentFS = parentFS
         self.masterBlock = self.parentFS.masterBlock
+        self.lazy = lazy
+        self.verbose = False  # print every allocation
+        self.dirtyInodes = {}  # inodeNum -> INode changed since the last sync
+        # bit i is set when inode i is in use; allocation searches it from
+        # the rotating nextFree hint, like BlockMap
+        self.inodeBitmap = Bitmap(self.masterBlock.inodeCount)
+        self.nextFree = 0
+        self.dirtyRegions = set()  # indexes of inode bitmap blocks changed since the last sync
+        self.lock = threading.RLock()  # for allocation, dirtyInodes and lazy loading
+        if lazy:
+            self.inodeMap = InodeTable(self, cacheSize)
+            return
         self.inodeMap = [INode(parentFS, x) for x in range(self.masterBlock.inodeCount)]
         self.setInode(self.masterBlock.rootDirAddress, INodeType.DIRECTORY)
 
+    def freeCount(self):
+        return self.masterBlock.inodeCount - self.inodeBitmap.setCount
+
+    def markInodeDirty(self, inode):
+        with self.lock:
+            inode.dirty = True
+            self.dirtyInodes[inode.inodeNum] = inode
+
+    def loadInode(self, inodeID):
+        blockNum, slot = self.masterBlock.inodeLocation(inodeID)
+        tableBlock = bytearray(self.masterBlock.blockSize)
+        self.parentFS.rBlockDev.read_block(blockNum, tableBlock)
+        inode = INode(self.parentFS, inodeID)
+        inode.fromBytes(tableBlock[slot:slot + self.masterBlock.inodeSlotSize])
+        return inode
+
     def setInode(self, inodeID, newState):
-        if (inodeID > self.masterBlock.inodeCount):
-            print("Error: InodeMap.setInode(): inodeID greater than file system's inodeCount.")
-            return False
-        if self.inodeMap[inodeID].flags != INodeType.FREE:
-            if (newState == INodeType.FREE):
-                self.inodeMap[inodeID].flags = INodeType.FREE
-                return True
-            else:
-                print("Error: InodeMap.setInode(): An inode already exists at specified inodeID.")
+        with self.lock:
+            if (inodeID >= self.masterBlock.inodeCount):
+                print("Error: InodeMap.setInode(): inodeID greater than file system's inodeCount.")
                 return False
-        self.inodeMap[inodeID].flags = newState
-        return True
+            if self.inodeMap[inodeID].flags != INodeType.FREE:
+                if (newState == INodeType.FREE):
+                    self.inodeMap[inodeID].flags = INodeType.FREE
+                    self.markInodeDirty(self.inodeMap[inodeID])
+                    self.setInodeBit(inodeID, False)
+                    return True
+                else:
+                    print("Error: InodeMap.setInode(): An inode already exists at specified inodeID.")
+                    return False
+            if newState != INodeType.FREE:
+                self.inodeMap[inodeID].reset()
+            self.inodeMap[inodeID].flags = newState
+            self.markInodeDirty(self.inodeMap[inodeID])
+            self.setInodeBit(inodeID, newState != INodeType.FREE)
+            return True
+
+    def setInodeBit(self, inodeID, inUse):
+        if self.inodeBitmap[inodeID] != inUse:
+            self.inodeBitmap[inodeID] = inUse
+            self.dirtyRegions.add(inodeID // (8 * self.masterBlock.blockSize))
 
     def allocateInode(self, type):
         """
-        returns block number(i) of allocated block if successful, -1 otherwise
+        returns inode number(i) of allocated inode if successful, -1 otherwise
+        the allocated inode is the first free one at or after the nextFree
+        hint, wrapping around to the start of the inode bitmap.
         """
-        try:
-            newInodeType = INodeType(ord(type))
-        except:
-            print("Error: allocateInode: Invalid Inode type given")
-            return -1
-
-        for i in range(0, self.masterBlock.inodeCount):
-            if self.inodeMap[i].flags == INodeType.FREE:
-                if self.setInode(i, newInodeType):
-                    print("Allocated Inode at " + str(i) + " to state" + type + ".\n")
-                    return i
-                else:
-                    print("Error inodeMap.allocateInode()")
-                    return -1
-        print("Error inodeMap.allocateInode(): inodeMap full")
-        return -1
+        with self.lock:
+            try:
+                newInodeType = INodeType(ord(type))
+            except:
+                print("Error: allocateInode: Invalid Inode type given")
+                return -1
+
+            if self.freeCount() == 0:
+                print("Error inodeMap.allocateInode(): inodeMap full")
+                return -1
+            i = self.inodeBitmap.findClear(self.nextFree)
+            if i == -1:
+                i = self.inodeBitmap.findClear(0, self.nextFree)
+            if not self.setInode(i, newInodeType):
+                print("Error inodeMap.allocateInode()")
+                return -1
+            if self.verbose:
+                print("Allocated Inode at " + str(i) + " to state" + type + ".\n")
+            self.nextFree = (i + 1) % self.masterBlock.inodeCount
+            return i
+
+    def allocateInodes(self, type, count):
+        """
+        allocate count inodes of one type, returns their inode numbers
+        (fewer than count if the inodeMap fills up)
+        """
+        with self.lock:
+            try:
+                newInodeType = INodeType(ord(type))
+            except:
+                print("Error: allocateInodes: Invalid Inode type given")
+                return []
+            if count > self.freeCount():
+                print("Error inodeMap.allocateInodes(): not enough free inodes")
+                count = self.freeCount()
+            allocated = []
+            while len(allocated) < count:
+                i = self.inodeBitmap.findClear(self.nextFree)
+                if i == -1:
+                    i = self.inodeBitmap.findClear(0, self.nextFree)
+                self.setInode(i, newInodeType)
+                self.nextFree = (i + 1) % self.masterBlock.inodeCount
+                allocated.append(i)
+            if self.verbose:
+                print("Allocated Inodes " + str(allocated) + " to state" + type + ".\n")
+            return allocated
 
     def freeInode(self, inodeID):
         if not self.setInode(inodeID, INodeType.FREE):
@@ -474,22 +1832,101 @@ class InodeMap:
                 printStr = printStr + "\n"
         print(printStr)
 
+    def tableBlockNums(self):
+        return [self.masterBlock.inodeMapAddress + i for i in range(self.masterBlock.inodeBlockCount)]
+
+    def packBitmap(self, blockDev, regions):
+        """ write the given blocks (region indexes) of the inode bitmap """
+        blockSize = self.masterBlock.blockSize
+        buffs = [self.inodeBitmap.toBytes(r * blockSize, (r + 1) * blockSize) for r in regions]
+        blockDev.write_blocks([self.masterBlock.inodeBitmapAddress + r for r in regions], buffs, True)
+        self.dirtyRegions.clear()
+
     def pack(self, blockDev):
-        startIndex = 1 + self.masterBlock.blockMapBlockCount
-        for i in range(self.masterBlock.inodeCount):
-            self.inodeMap[i].pack(blockDev, startIndex + i)
+        """
+        inodes are stored inodesPerBlock to a block (one per block in
+        format_legacy), so the table is written a block at a time
+        """
+        tableBlocks = [bytearray(self.masterBlock.blockSize) for b in self.tableBlockNums()]
+        for inode in self.inodeMap:
+            blockNum, slot = self.masterBlock.inodeLocation(inode.inodeNum)
+            inodeBytes = inode.toBytes()
+            tableBlocks[blockNum - self.masterBlock.inodeMapAddress][slot:slot + len(inodeBytes)] = inodeBytes
+        blockDev.write_blocks(self.tableBlockNums(), tableBlocks)
+        for inode in self.inodeMap:
+            inode.dirty = False
+        self.dirtyInodes.clear()
+        self.packBitmap(blockDev, range(self.masterBlock.inodeBitmapBlockCount))
+
+    def sync(self, blockDev):
+        """
+        write only the inode table blocks holding inodes that changed since
+        the last sync. When a table block holds more than one inode it is
+        read first, so inodes that are not loaded (see InodeTable) survive.
+        """
+        tableBlocks = {}
+        for inode in self.dirtyInodes.values():
+            blockNum, slot = self.masterBlock.inodeLocation(inode.inodeNum)
+            tableBlocks.setdefault(blockNum, []).append((slot, inode))
+        blockNums = sorted(tableBlocks)
+        buffs = [bytearray(self.masterBlock.blockSize) for b in blockNums]
+        if self.masterBlock.inodesPerBlock > 1:
+            blockDev.read_blocks(blockNums, buffs)
+        for blockNum, buff in zip(blockNums, buffs):
+            for slot, inode in tableBlocks[blockNum]:
+                inodeBytes = inode.toBytes()
+                buff[slot:slot + len(inodeBytes)] = inodeBytes
+                inode.dirty = False
+        blockDev.write_blocks(blockNums, buffs)
+        self.dirtyInodes.clear()
+        if self.masterBlock.inodeBitmapBlockCount:
+            self.packBitmap(blockDev, sorted(self.dirtyRegions))
+
+    def unpackBitmap(self, blockDev):
+        """
+        load the inode bitmap. Formats from before format_inode_bitmap have
+        none on disk, so it is rebuilt from the flags byte of every inode slot
+        """
+        blockSize = self.masterBlock.blockSize
+        if self.masterBlock.inodeBitmapBlockCount:
+            blockNums = [self.masterBlock.inodeBitmapAddress + i
+                         for i in range(self.masterBlock.inodeBitmapBlockCount)]
+        else:
+            blockNums = self.tableBlockNums()
+        buffs = [bytearray(blockSize) for b in blockNums]
+        blockDev.read_blocks(blockNums, buffs)
+        if self.masterBlock.inodeBitmapBlockCount:
+            self.inodeBitmap = Bitmap(self.masterBlock.inodeCount, b"".join(buffs))
+        else:
+            slots = np.frombuffer(b"".join(buffs), dtype=np.uint8).reshape(-1, self.masterBlock.inodeSlotSize)
+            flags = slots[:self.masterBlock.inodeCount, INode.Flags_Offset]
+            self.inodeBitmap = Bitmap(self.masterBlock.inodeCount,
+                                      np.packbits(flags != INodeType.FREE.value).tobytes())
+        self.nextFree = 0
+        self.dirtyRegions.clear()
 
     def unpack(self, blockDev):
         """
         on unpack (as part of unmount) we must update our masterblock reference and inital blockmap size
 
-        we unpack every inode, starting at block after blockmap
+        we read the whole inode table with one vectored read, then unpack
+        every inode from its slot. A lazy InodeMap reads nothing here, its
+        InodeTable loads inodes as they are used.
         """
         self.masterBlock = self.parentFS.masterBlock
+        self.dirtyInodes.clear()
+        self.unpackBitmap(blockDev)
+        if self.lazy:
+            self.inodeMap = InodeTable(self, self.inodeMap.cacheSize)
+            return
 
-        startIndex = 1 + self.masterBlock.blockMapBlockCount
+        blockNums = self.tableBlockNums()
+        buffs = [bytearray(self.masterBlock.blockSize) for b in blockNums]
+        blockDev.read_blocks(blockNums, buffs)
+        slotSize = self.masterBlock.inodeSlotSize
         for i in range(0, self.masterBlock.inodeCount, ):
-            self.inodeMap[i].unpack(blockDev, startIndex + i)
+            blockNum, slot = self.masterBlock.inodeLocation(i)
+            self.inodeMap[i].fromBytes(buffs[blockNum - self.masterBlock.inodeMapAddress][slot:slot + slotSize])
 
 #integer divide x by y and return next highest (toward infinities) integer
 def cielDiv(x,y):
@@ -603,4 +2040,1049 @@ def test_write_and_read():
     testInode.read(testRead, 27124)
 
 
-    assert str(testRead.decode("ascii")) == "A cat is Here"
\ No newline at end of file
+    assert str(testRead.decode("ascii")) == "A cat is Here"
+
+
+def test_mmap_mount():
+    FileSystem.createFileSystem("testMmap", 2048, 2048)
+    testFS = FileSystem.mount("testMmap.2048.dev", useMmap=True)
+
+    testFS.inodeMap.allocateInode("f")
+    testInode = testFS.inodeMap.inodeMap[1]
+
+    testWrite = "A cat is Here".encode('ascii')
+    testInode.write(testWrite, 100)
+
+    dataBlock = testFS.retrieveBlock(testInode.blockPtrs[0])
+    assert isinstance(dataBlock, memoryview), "mapped mount should cache block views"
+
+    testRead = bytearray(len(testWrite))
+    testInode.read(testRead, 100)
+    assert testRead == testWrite
+    del dataBlock
+
+    testFS.unmount()
+    testFS = FileSystem.mount("testMmap.2048.dev", useMmap=True)
+    testRead = bytearray(len(testWrite))
+    testFS.inodeMap.inodeMap[1].read(testRead, 100)
+    assert testRead == testWrite
+    testFS.unmount()
+
+
+def test_multi_block_write_read():
+    FileSystem.createFileSystem("testVectored", 2048, 1024)
+    testFS = FileSystem.mount("testVectored.dev")
+
+    testFS.inodeMap.allocateInode("f")
+    testInode = testFS.inodeMap.inodeMap[1]
+    testInode.truncate(8 * 1024)
+
+    testWrite = bytearray(i % 251 for i in range(5 * 1024))
+    testInode.write(testWrite, 0)
+    testFS.unmount()
+
+    testFS = FileSystem.mount("testVectored.dev")
+    testRead = bytearray(len(testWrite))
+    testFS.inodeMap.inodeMap[1].read(testRead, 0)
+    assert testRead == testWrite, "multi-block file did not survive unmount"
+
+
+def test_bounded_block_cache():
+    FileSystem.createFileSystem("testCache", 2048, 1024)
+    testFS = FileSystem.mount("testCache.dev", cacheBytes=4 * 1024)
+
+    testFS.inodeMap.allocateInode("f")
+    testInode = testFS.inodeMap.inodeMap[1]
+    testInode.truncate(16 * 1024)
+
+    testWrite = bytearray(i % 251 for i in range(12 * 1024))
+    testInode.write(testWrite, 0)
+    assert len(testFS.blockCache) <= 4, "block cache grew past its budget"
+    assert testFS.blockCache.writeBacks > 0, "dirty blocks were evicted without write-back"
+
+    testRead = bytearray(1024)
+    testInode.read(testRead, 11 * 1024)
+    testInode.read(testRead, 11 * 1024)
+    assert testFS.blockCache.hits > 0
+    testFS.unmount()
+
+    testFS = FileSystem.mount("testCache.dev", cacheBytes=4 * 1024)
+    testRead = bytearray(len(testWrite))
+    testFS.inodeMap.inodeMap[1].read(testRead, 0)
+    assert testRead == testWrite, "evicted blocks did not reach the device"
+
+
+def test_incremental_sync():
+    FileSystem.createFileSystem("testSync", 2048, 1024, format_inode_bitmap)  # data in blocks
+    testFS = FileSystem.mount("testSync.dev")
+
+    testFS.inodeMap.allocateInode("f")
+    testFS.inodeMap.inodeMap[1].write(b"x_", 0)
+    testFS.sync()
+
+    written = []
+    writeBlocks = testFS.rBlockDev.write_blocks
+    def countingWriteBlocks(blockNums, buffs, pad=False):
+        written.extend(blockNums)
+        writeBlocks(blockNums, buffs, pad)
+    testFS.rBlockDev.write_blocks = countingWriteBlocks
+
+    testFS.inodeMap.inodeMap[1].write(b"y", 1)  # same length, the inode is clean
+    testFS.sync()
+    assert written == [testFS.inodeMap.inodeMap[1].blockPtrs[0]], "sync wrote unchanged blocks"
+
+    del written[:]
+    testFS.inodeMap.allocateInode("f")
+    testFS.inodeMap.inodeMap[2].write(b"z", 0)
+    testFS.sync()
+    assert len(written) == 4, "expected block map, inode bitmap, inode and data block"
+    testFS.unmount()
+
+    testFS = FileSystem.mount("testSync.dev")
+    testRead = bytearray(2)
+    testFS.inodeMap.inodeMap[1].read(testRead, 0)
+    assert testRead == b"xy"
+    assert testFS.inodeMap.inodeMap[2].flags == INodeType.FILE
+
+
+def test_lazy_inode_loading():
+    FileSystem.createFileSystem("testLazy", 2048, 1024)
+    testFS = FileSystem.mount("testLazy.dev", lazyInodes=True, inodeCacheSize=2)
+    assert testFS.inodeMap.inodeMap.loads == 1, "mount should only load the root inode"
+
+    testFS.inodeMap.setInode(7, INodeType.FILE)
+    testFS.inodeMap.inodeMap[7].write(b"lazy", 0)
+    for i in range(8, 16):
+        testFS.inodeMap.inodeMap[i]
+    assert testFS.inodeMap.inodeMap[7].flags == INodeType.FILE, "dirty inode was dropped from the cache"
+    testFS.unmount()
+
+    testFS = FileSystem.mount("testLazy.dev", lazyInodes=True)
+    testRead = bytearray(4)
+    testFS.inodeMap.inodeMap[7].read(testRead, 0)
+    assert testRead == b"lazy"
+    assert testFS.inodeMap.inodeMap.loads == 2
+
+
+def test_packed_inode_table():
+    FileSystem.createFileSystem("testPacked", 2048, 1024)
+    testFS = FileSystem.mount("testPacked.dev")
+    assert testFS.masterBlock.formatVersion >= format_packed_inodes
+    assert testFS.masterBlock.inodeBlockCount == 256 // (1024 // INode.Inode_Size)
+    assert testFS.masterBlock.journalAddress == testFS.masterBlock.inodeMapAddress + testFS.masterBlock.inodeBlockCount
+    assert not testFS.blockMap.blockMap[testFS.masterBlock.journalAddress + testFS.masterBlock.journalBlockCount]
+
+    testFS.inodeMap.setInode(9, INodeType.FILE)
+    testFS.inodeMap.inodeMap[9].truncate(123)
+    testFS.unmount()
+
+    testFS = FileSystem.mount("testPacked.dev", lazyInodes=True)
+    assert testFS.inodeMap.inodeMap[9].flags == INodeType.FILE
+    assert testFS.inodeMap.inodeMap[9].length == 123
+    assert testFS.inodeMap.inodeMap[8].flags == INodeType.FREE
+
+
+def test_legacy_format():
+    FileSystem.createFileSystem("testLegacy", 2048, 1024, format_legacy)
+    testFS = FileSystem.mount("testLegacy.dev")
+    assert testFS.masterBlock.formatVersion == format_legacy
+    assert testFS.masterBlock.inodeBlockCount == 256
+    testFS.inodeMap.setInode(3, INodeType.DIRECTORY)
+    testFS.unmount()
+
+    testFS = FileSystem.mount("testLegacy.dev")
+    assert testFS.inodeMap.inodeMap[3].flags == INodeType.DIRECTORY
+
+
+def test_bitmap_allocator():
+    FileSystem.createFileSystem("testBitmap", 2048, 1024)
+    testFS = FileSystem.mount("testBitmap.dev")
+    blockMap = testFS.blockMap
+    freeCount = blockMap.freeCount()
+    firstFree = blockMap.blockMap.findClear()
+
+    allocated = [blockMap.allocateBlock() for i in range(100)]
+    assert allocated == list(range(firstFree, firstFree + 100))
+    assert blockMap.freeCount() == freeCount - 100
+
+    blockMap.freeBlock(allocated[10])
+    assert blockMap.allocateBlock() == allocated[-1] + 1, "allocation should continue from the hint"
+    while blockMap.freeCount() > 1:
+        blockMap.allocateBlock()
+    assert blockMap.allocateBlock() == allocated[10], "allocation should wrap around"
+    assert blockMap.allocateBlock() == -1
+    testFS.unmount()
+
+    testFS = FileSystem.mount("testBitmap.dev")
+    assert testFS.blockMap.freeCount() == 0
+
+
+def test_extent_allocation():
+    FileSystem.createFileSystem("testExtent", 2048, 1024)
+    testFS = FileSystem.mount("testExtent.dev")
+    blockMap = testFS.blockMap
+
+    start, count = blockMap.allocate_extent(5)
+    assert count == 5
+    blockMap.freeBlock(start + 2)
+    assert blockMap.allocate_extent(3, near=start) == (start + 5, 3), "extent must be contiguous"
+    assert blockMap.allocate_extent(1, near=start) == (start + 2, 1)
+
+    testFS.inodeMap.allocateInode("f")
+    testInode = testFS.inodeMap.inodeMap[1]
+    testInode.truncate(20 * 1024)
+    freeCount = blockMap.freeCount()
+    testInode.write(bytearray(10 * 1024), 0)
+    assert blockMap.freeCount() == freeCount - 10, "unused extent blocks were not returned"
+    firstBlock = testInode.blockPtrs[0]
+    assert testInode.blockPtrs[:10] == list(range(firstBlock, firstBlock + 10))
+
+    testInode.write(bytearray(1024), 10 * 1024)
+    assert testInode.blockPtrs[10] == firstBlock + 10, "appends should stay next to the file"
+
+
+def test_inode_bitmap_allocator():
+    FileSystem.createFileSystem("testInodeBitmap", 2048, 1024)
+    testFS = FileSystem.mount("testInodeBitmap.dev", lazyInodes=True)
+    inodeMap = testFS.inodeMap
+    assert inodeMap.freeCount() == 255
+
+    allocated = [inodeMap.allocateInode("f") for i in range(10)]
+    assert allocated == list(range(1, 11))
+    assert inodeMap.inodeMap.loads == 11, "allocation should only load the inodes it hands out"
+    inodeMap.freeInode(5)
+    assert inodeMap.freeCount() == 246
+    testFS.unmount()
+
+    testFS = FileSystem.mount("testInodeBitmap.dev", lazyInodes=True)
+    assert testFS.inodeMap.freeCount() == 246
+    assert testFS.inodeMap.allocateInode("d") == 5
+    assert testFS.inodeMap.inodeMap[5].flags == INodeType.DIRECTORY
+
+
+def test_inode_bitmap_legacy_rebuild():
+    FileSystem.createFileSystem("testInodeLegacy", 2048, 1024, format_packed_inodes)
+    testFS = FileSystem.mount("testInodeLegacy.dev")
+    testFS.inodeMap.allocateInode("f")
+    testFS.inodeMap.allocateInode("f")
+    testFS.unmount()
+
+    testFS = FileSystem.mount("testInodeLegacy.dev", lazyInodes=True)
+    assert testFS.inodeMap.freeCount() == 253
+    assert testFS.inodeMap.allocateInode("f") == 3
+
+
+def test_dentry_cache():
+    FileSystem.createFileSystem("testDentry", 2048, 1024)
+    testFS = FileSystem.mount("testDentry.dev")
+    testFS.makeDir("a")
+    testFS.makeDir("a/b")
+    testFS.makeFile("a/b/c")
+
+    assert testFS.namei("a/b/missing") == (None, None)
+    fileInode, parentInode = testFS.namei("a/b/c")
+    misses = testFS.dentryCache.misses
+    assert testFS.namei("a/b/c") == (fileInode, parentInode)
+    assert testFS.dentryCache.misses == misses, "repeated lookups should be cache hits"
+    assert testFS.dentryCache.lookup(parentInode.inodeNum, "missing") is None
+
+    testFS.makeFile("a/b/missing")
+    assert testFS.namei("a/b/missing")[0] is not None, "add_child must drop the negative entry"
+
+
+def test_hashed_directory():
+    FileSystem.createFileSystem("testHashedDir", 2048, 1024, dirFormat=dir_format_hashed)
+    testFS = FileSystem.mount("testHashedDir.dev")
+    testFS.makeDir("big")
+    bigInode, parentInode = testFS.namei("big")
+    bigDir = testFS.getDirectory(bigInode, parentInode)
+    assert bigDir.isHashed()
+
+    names = ["file{}".format(i) for i in range(3000)]
+    for i, name in enumerate(names):
+        bigDir.index.insert(name, i % 200)
+    assert bigDir.index.bucketCount() > 1, "the index should have split"
+    for i, name in enumerate(names):
+        assert bigDir.lookup(name) == i % 200
+    assert bigDir.remove_child("file7")
+    assert bigDir.lookup("file7") is None
+    assert not bigDir.remove_child("file7")
+
+    testFS.makeDir("text", dir_format_text)
+    textInode, parentInode = testFS.namei("text")
+    assert not testFS.getDirectory(textInode, parentInode).isHashed()
+    testFS.makeFile("text/a")
+    testFS.unmount()
+
+    testFS = FileSystem.mount("testHashedDir.dev")
+    assert testFS.namei("big/file2999")[0].inodeNum == 2999 % 200
+    assert testFS.namei("big/file7") == (None, None)
+    assert testFS.namei("big/..")[0].inodeNum == 0
+    assert sorted(testFS.getDirectory(*testFS.namei("text")).get_children()) == [".", "..", "a"]
+    assert len(testFS.getDirectory(*testFS.namei("big")).get_children()) == 3001
+
+
+def test_create_many():
+    FileSystem.createFileSystem("testCreateMany", 2048, 1024)
+    testFS = FileSystem.mount("testCreateMany.dev")
+    testFS.makeDir("text")
+    testFS.makeDir("hashed", dir_format_hashed)
+
+    for dirName in ("text", "hashed"):
+        names = ["f{}".format(i) for i in range(100)]
+        inodeNums = testFS.create_many(dirName, names, "f")
+        assert len(inodeNums) == 100
+        assert testFS.create_many(dirName, ["f0", "g"], "f") == [inodeNums[-1] + 1], "existing names are skipped"
+        testFS.create_many(dirName, ["sub1", "sub2"], "d")
+        for i in (0, 50, 99):
+            assert testFS.namei(dirName + "/f{}".format(i))[0].inodeNum == inodeNums[i]
+        subInode, parentInode = testFS.namei(dirName + "/sub2/..")
+        assert subInode is testFS.namei(dirName)[0]
+        assert len(testFS.getDirectory(*testFS.namei(dirName)).get_children()) == 105
+
+    # a name given twice is created once, and nothing is reported as existing
+    printed = io.StringIO()
+    with contextlib.redirect_stdout(printed):
+        inodeNums = testFS.create_many("text", ["twice", "twice"], "f")
+    assert len(inodeNums) == 1 and testFS.namei("text/twice")[0].inodeNum == inodeNums[0]
+    assert "Error" not in printed.getvalue()
+    with contextlib.redirect_stdout(printed):
+        assert testFS.create_many("text", ["twice", "once"], "f") == [inodeNums[0] + 1]
+    assert "already exists: twice" in printed.getvalue()
+
+
+def test_directory_object_cache():
+    FileSystem.createFileSystem("testDirCache", 2048, 1024)
+    testFS = FileSystem.mount("testDirCache.dev")
+    testFS.makeDir("a")
+    testFS.makeFile("a/x")
+
+    dirInode, parentInode = testFS.namei("a")
+    dir = testFS.getDirectory(dirInode)
+    assert testFS.getDirectory(dirInode) is dir
+    children = dir.get_children()
+    assert dir.get_children() is children, "children should not be parsed again"
+    assert children["."] is dir
+
+    testFS.makeFile("a/y")
+    assert dir.get_children() is children
+    assert sorted(children) == [".", "..", "x", "y"]
+    testFS.unmount()
+
+    testFS = FileSystem.mount("testDirCache.dev")
+    assert sorted(testFS.getDirectory(*testFS.namei("a")).get_children()) == [".", "..", "x", "y"]
+
+
+def test_unaligned_read_write():
+    FileSystem.createFileSystem("testUnaligned", 2048, 1024)
+    testWrite = bytes(i % 251 for i in range(3 * 1024 + 500))
+    for useMmap in (False, True):
+        testFS = FileSystem.mount("testUnaligned.dev", useMmap=useMmap)
+        inodeNum = testFS.inodeMap.allocateInode("f")
+        testInode = testFS.inodeMap.inodeMap[inodeNum]
+        testInode.truncate(8 * 1024)
+        assert testInode.write(testWrite, 300) == len(testWrite)
+        assert testInode.write(b"", 0) == 0
+        testFS.unmount()
+
+        testFS = FileSystem.mount("testUnaligned.dev", useMmap=useMmap)
+        testInode = testFS.inodeMap.inodeMap[inodeNum]
+        testRead = bytearray(len(testWrite))
+        assert testInode.read(testRead, 300) == len(testWrite)
+        assert testRead == testWrite
+        # starts and ends inside a block, with whole blocks in between
+        testRead = bytearray(2 * 1024 + 10)
+        assert testInode.read(memoryview(testRead), 1000) == len(testRead)
+        assert testRead == testWrite[700:700 + len(testRead)]
+        testFS.unmount()
+
+
+def test_indirect_block_mapping():
+    FileSystem.createFileSystem("testIndirect", 2048, 1024)
+    for useMmap in (False, True):
+        testFS = FileSystem.mount("testIndirect.dev", useMmap=useMmap)
+        inodeNum = testFS.inodeMap.allocateInode("f")
+        testInode = testFS.inodeMap.inodeMap[inodeNum]
+        testInode.level = 1
+        testInode.truncate(300 * 1024)
+
+        testWrite = bytes(i % 253 for i in range(300 * 1024))
+        testInode.write(testWrite, 0)
+        assert len(testInode.blockAddrs) == 300
+        testFS.unmount()
+
+        testFS = FileSystem.mount("testIndirect.dev", useMmap=useMmap)
+        testInode = testFS.inodeMap.inodeMap[inodeNum]
+        assert testInode.blockAddrs == {}
+        testRead = bytearray(len(testWrite))
+        testInode.read(testRead, 0)
+        assert testRead == testWrite
+        # the remembered addresses agree with the first pointer block
+        ptrs = testInode.blockToBlockPtrs(testFS.retrieveBlock(testInode.blockPtrs[0], metadata=True))
+        assert [testInode.blockAddrs[i] for i in range(256)] == list(ptrs)
+        del ptrs
+        testFS.unmount()
+
+    # however big the file, only so many addresses are remembered
+    testFS = FileSystem.mount("testIndirect.dev")
+    testInode = testFS.inodeMap.inodeMap[inodeNum]
+    testWrite = bytes(i % 247 for i in range((INode.Addr_Memo_Size + 100) * 1024))
+    assert testInode.write(testWrite, 0) == len(testWrite)
+    testRead = bytearray(len(testWrite))
+    testInode.read(testRead, 0)
+    assert testRead == testWrite
+    assert 0 < len(testInode.blockAddrs) <= INode.Addr_Memo_Size
+    testFS.unmount()
+
+
+def test_pointer_update_after_eviction():
+    FileSystem.createFileSystem("testPtrEvict", 2048, 1024)
+    testFS = FileSystem.mount("testPtrEvict.dev")
+    inodeNum = testFS.inodeMap.allocateInode("f")
+    testInode = testFS.inodeMap.inodeMap[inodeNum]
+    testInode.write(bytes(40 * 1024), 0)  # more blocks than direct pointers
+    ptrBlock = testInode.blockPtrs[0]
+    ptrs = testInode.blockToBlockPtrs(testFS.retrieveBlock(ptrBlock, metadata=True))
+    # cache pressure evicts the pointer block while the view is held
+    testFS.blockCache.flush(testFS.rBlockDev)
+    testFS.blockCache.discard(ptrBlock)
+    newBlock = testFS.allocBlock()
+    testInode.setBlockPtr(ptrs, 50, newBlock, ptrBlock)
+    del ptrs
+    testFS.unmount()
+
+    testFS = FileSystem.mount("testPtrEvict.dev")
+    ptrs = testFS.inodeMap.inodeMap[inodeNum].blockToBlockPtrs(testFS.retrieveBlock(ptrBlock, metadata=True))
+    assert ptrs[50] == newBlock
+    del ptrs
+    testFS.unmount()
+
+
+def test_write_disk_full():
+    FileSystem.createFileSystem("testFull", 256, 1024)
+    testFS = FileSystem.mount("testFull.dev")
+    testFS.makeFile("big")
+    testFile = testFS.open("big", "w")
+    testWrite = bytes(i % 251 for i in range(300 * 1024))
+    count = testFile.write(testWrite)
+    assert 0 < count < len(testWrite) and count % 1024 == 0
+    assert testFile.inode.length == count
+    assert testFS.blockMap.freeCount() == 0
+    testFS.unmount()
+
+    testFS = FileSystem.mount("testFull.dev")
+    assert testFS.open("big", "r").read() == testWrite[:count]
+    testFS.unmount()
+
+
+def test_sparse_file():
+    FileSystem.createFileSystem("testSparse", 2048, 1024)
+    testFS = FileSystem.mount("testSparse.dev")
+    freeBlocks = testFS.blockMap.freeCount()
+
+    inodeNum = testFS.inodeMap.allocateInode("f")
+    testFile = File(testFS.inodeMap.inodeMap[inodeNum], None)
+    testFile.truncate(27624)
+    testFile.inode.level = 1
+    testRead = bytearray(27624)
+    testFile.read(testRead)
+    assert testRead == bytes(27624)
+    assert testFS.blockMap.freeCount() == freeBlocks, "reading a hole allocated blocks"
+
+    testFile.seek(27124)
+    testFile.write(b"A cat is Here")
+    assert testFS.blockMap.freeCount() == freeBlocks - 2  # data and pointer block
+    testFile.seek(0, FileSeek.DATA)
+    assert testFile.offset == 26 * 1024
+    testFile.seek(26 * 1024 + 10, FileSeek.HOLE)
+    assert testFile.offset == 27624  # the end of the file
+    testFile.seek(10, FileSeek.HOLE)
+    assert testFile.offset == 10
+    testFS.unmount()
+
+    testFS = FileSystem.mount("testSparse.dev")
+    testFile = File(testFS.inodeMap.inodeMap[inodeNum], None)
+    testRead = bytearray(1024)
+    testFile.seek(26 * 1024)
+    testFile.read(testRead)
+    assert testRead[500:513] == b"A cat is Here" and testRead.count(0) == 1024 - 13
+
+    testFile.punch_hole(27124, 5)
+    testFile.seek(26 * 1024)
+    testFile.read(testRead)
+    assert testRead[500:513] == bytes(5) + b" is Here"
+    testFile.punch_hole(0, 27624)
+    assert testFS.blockMap.freeCount() == freeBlocks
+    testFile.seek(0)
+    testFile.write(b"A cat")
+    testFile.truncate(3)
+    testFile.truncate(20)
+    testFile.seek(0)
+    testRead = bytearray(20)
+    testFile.read(testRead)
+    assert testRead == b"A c" + bytes(17)
+    testFS.freeINode(inodeNum)
+    assert testFS.blockMap.freeCount() == freeBlocks
+    testFS.unmount()
+
+
+def test_level_growth():
+    FileSystem.createFileSystem("testGrowth", 4096, 128)
+    testFS = FileSystem.mount("testGrowth.128.dev")
+    inodeNum = testFS.inodeMap.allocateInode("f")
+    testInode = testFS.inodeMap.inodeMap[inodeNum]
+    assert testInode.length == 0 and testInode.level == 0
+
+    # 32 pointers per block: level 0 holds 26 blocks, level 1 832, level 2 26624
+    chunk = bytes(i % 241 for i in range(1000))
+    for i in range(120):
+        assert testInode.write(chunk, i * len(chunk)) == len(chunk)
+        assert testInode.length == (i + 1) * len(chunk)
+    assert testInode.level == 2
+    testFS.unmount()
+
+    testFS = FileSystem.mount("testGrowth.128.dev")
+    testInode = testFS.inodeMap.inodeMap[inodeNum]
+    testRead = bytearray(120 * len(chunk))
+    testInode.read(testRead, 0)
+    assert testRead == chunk * 120
+
+    freeBlocks = testFS.blockMap.freeCount()
+    testInode.truncate(0)
+    assert testInode.level == 0
+    assert testFS.blockMap.freeCount() - freeBlocks == 938 + 1 + 30  # data, level 2 and level 1 pointer blocks
+
+
+def test_wide_length():
+    FileSystem.createFileSystem("testWide", 2048, 1024)
+    testFS = FileSystem.mount("testWide.dev")
+    testFS.makeFile("log")
+    testFile = testFS.open("log", "w")
+    testWrite = bytes(i % 251 for i in range(3000))
+    offset = 2**32 + 2**31 + 100  # past what 32 bits hold, sparse up to there
+    testFile.seek(offset)
+    assert testFile.write(testWrite) == len(testWrite)
+    assert testFile.inode.length == offset + len(testWrite)
+    testFS.unmount()
+
+    testFS = FileSystem.mount("testWide.dev")
+    testFile = testFS.open("log", "r")
+    assert testFile.inode.length == offset + len(testWrite)
+    testFile.seek(offset - 10)
+    assert testFile.read(len(testWrite) + 10) == bytes(10) + testWrite
+    testFS.unmount()
+
+    # older formats still pack the length in 32 bits, and refuse more
+    FileSystem.createFileSystem("testNarrow", 2048, 1024, formatVersion=format_journal)
+    testFS = FileSystem.mount("testNarrow.dev")
+    testFS.makeFile("log")
+    testFile = testFS.open("log", "w")
+    testFile.seek(2**31)
+    assert testFile.write(testWrite) == 0
+    assert testFile.inode.length == 0
+    testFile.seek(0)
+    testFile.write(testWrite)
+    testFS.unmount()
+    testFS = FileSystem.mount("testNarrow.dev")
+    assert testFS.open("log", "r").read() == testWrite
+    testFS.unmount()
+
+
+def test_inline_data():
+    FileSystem.createFileSystem("testInline", 2048, 1024)
+    testFS = FileSystem.mount("testInline.dev")
+    freeBlocks = testFS.blockMap.freeCount()
+
+    testFS.makeDir("d")
+    testFS.makeFile("d/small")
+    dirInode, parentInode = testFS.namei("d")
+    fileInode, parentInode = testFS.namei("d/small")
+    assert dirInode.inline and fileInode.inline
+    assert fileInode.write(b"A cat is Here", 5) == 13
+    assert fileInode.length == 18
+    assert testFS.blockMap.freeCount() == freeBlocks, "small files should not take blocks"
+    testFS.unmount()
+
+    testFS = FileSystem.mount("testInline.dev")
+    fileInode, parentInode = testFS.namei("d/small")
+    assert fileInode.inline
+    testRead = bytearray(20)
+    fileInode.read(testRead, 0)
+    assert testRead == bytes(5) + b"A cat is Here" + bytes(2)
+
+    # outgrowing the inode moves the data to a block
+    testWrite = bytes(i % 251 for i in range(INode.Inline_Size))
+    fileInode.write(testWrite, 18)
+    assert not fileInode.inline
+    assert testFS.blockMap.freeCount() == freeBlocks - 1
+    testRead = bytearray(18 + len(testWrite))
+    fileInode.read(testRead, 0)
+    assert testRead == bytes(5) + b"A cat is Here" + testWrite
+
+    fileInode.truncate(0)
+    assert fileInode.inline and testFS.blockMap.freeCount() == freeBlocks
+    testFS.unmount()
+
+    FileSystem.createFileSystem("testInlineOld", 2048, 1024, format_inode_bitmap)
+    testFS = FileSystem.mount("testInlineOld.dev")
+    testFS.makeFile("small")
+    assert not testFS.namei("small")[0].inline
+
+
+def test_streaming_file():
+    import hashlib
+    import shutil
+    FileSystem.createFileSystem("testStream", 2048, 1024)
+    testFS = FileSystem.mount("testStream.dev")
+    testFS.makeFile("log")
+
+    lines = [("line %d of the log\n" % i).encode("ascii") for i in range(5000)]
+    source = io.BytesIO(b"".join(lines))
+    with testFS.openBuffered("log", "w") as log:
+        shutil.copyfileobj(source, log, 3000)
+    with testFS.openBuffered("log", "a") as log:
+        log.write(b"the end\n")
+    lines.append(b"the end\n")
+    contents = b"".join(lines)
+
+    with testFS.openBuffered("log", "r") as log:
+        assert list(log) == lines
+    digest = hashlib.sha256()
+    for chunk in testFS.open("log", "r").chunks(1000):
+        assert len(chunk) <= 1000
+        digest.update(chunk)
+    assert digest.digest() == hashlib.sha256(contents).digest()
+
+    testFile = testFS.open("log", "r")
+    assert testFile.seek(-8, io.SEEK_END) == len(contents) - 8
+    testRead = bytearray(100)
+    assert testFile.read(testRead) == 8 and testFile.tell() == len(contents)
+    assert testRead[:8] == b"the end\n"
+    assert testFile.read(testRead) == 0 and testFile.read() == b""
+    testFile.seek(5)
+    assert testFile.read(4) == b"0 of"
+
+
+def test_write_buffer():
+    FileSystem.createFileSystem("testWriteBuffer", 2048, 1024)
+    testFS = FileSystem.mount("testWriteBuffer.dev")
+    testFS.makeFile("log")
+
+    inodeWrites = []
+    log = testFS.open("log", "a", writeBuffer=4096)
+    inodeWrite = log.inode.write
+    def countingWrite(buffer, file_offset):
+        inodeWrites.append((file_offset, len(buffer)))
+        return inodeWrite(buffer, file_offset)
+    log.inode.write = countingWrite
+
+    lines = [("entry %d\n" % i).encode("ascii") for i in range(1000)]
+    for line in lines:
+        assert log.write(line) == len(line)
+    # whole blocks go out once the buffer fills, the rest waits for a flush
+    assert all(offset % 1024 == 0 and (offset + count) % 1024 == 0 for offset, count in inodeWrites)
+    assert len(inodeWrites) < 5
+    assert log.inode.length < len(b"".join(lines))
+    log.close()
+    assert log.inode.length == len(b"".join(lines))
+
+    # reads see buffered writes, and a seek ends the sequential run
+    log = testFS.open("log", "r", writeBuffer=4096)
+    log.seek(6)
+    log.write(b"X")
+    log.seek(0)
+    assert log.read(10) == b"entry X\nen"
+    log.seek(0, io.SEEK_END)
+    log.write(b"tail")
+    log.sync()
+    testFS.unmount()
+
+    testFS = FileSystem.mount("testWriteBuffer.dev")
+    assert testFS.open("log", "r").read() == b"entry X\n" + b"".join(lines[1:]) + b"tail"
+
+
+def test_read_ahead():
+    FileSystem.createFileSystem("testReadAhead", 2048, 1024)
+    testFS = FileSystem.mount("testReadAhead.dev")
+    testFS.makeFile("big")
+    testWrite = bytes(i % 251 for i in range(400 * 1024))
+    testFS.open("big", "w").write(testWrite)
+    testFS.unmount()
+
+    testFS = FileSystem.mount("testReadAhead.dev")
+    deviceReads = []
+    readBlocks = testFS.rBlockDev.read_blocks
+    def countingReadBlocks(blockNums, buffs):
+        deviceReads.append(len(blockNums))
+        readBlocks(blockNums, buffs)
+    testFS.rBlockDev.read_blocks = countingReadBlocks
+
+    # a sequential reader is read ahead of, further and further
+    testFile = testFS.open("big", "r")
+    testRead = b"".join(testFile.chunks(512))
+    assert testRead == testWrite
+    assert testFS.blockCache.readAheads > 300
+    assert len(deviceReads) < 40
+    assert max(deviceReads) >= testFS.readAhead // 2  # half a window per refill
+
+    # random reads are not
+    readAheads = testFS.blockCache.readAheads
+    testInode = testFile.inode
+    for offset in (300 * 1024, 7 * 1024, 150 * 1024):
+        testInode.read(bytearray(100), offset)
+    assert testFS.blockCache.readAheads == readAheads
+
+
+def test_flusher():
+    FileSystem.createFileSystem("testFlusher", 2048, 1024)
+    testFS = FileSystem.mount("testFlusher.dev", flushAge=0.05)
+    flusher = testFS.blockCache.flusher
+    flusher.interval = 0.01
+    testFS.makeFile("a")
+    testWrite = bytes(i % 251 for i in range(20 * 1024))
+    testFS.open("a", "w").write(testWrite)
+    assert testFS.blockCache.dirtyBytes() > 0
+    deadline = time.monotonic() + 5
+    while testFS.blockCache.dirtyBytes() > 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert testFS.blockCache.dirtyBytes() == 0, "old dirty blocks were not written back"
+
+    # the data is on the device, though nothing has been synced
+    dataBlock = bytearray(1024)
+    testFS.rBlockDev.read_block(testFS.namei("a")[0].getDiskAddrOfBlock(3), dataBlock)
+    assert dataBlock == testWrite[3 * 1024:4 * 1024]
+    testFS.unmount()
+    assert not flusher.is_alive()
+
+    # with a dirty-bytes limit the flusher is woken as soon as it is passed
+    testFS = FileSystem.mount("testFlusher.dev", flushBytes=8 * 1024)
+    testFS.blockCache.flusher.interval = 60
+    testFS.open("a", "w").write(bytes(len(testWrite)))
+    deadline = time.monotonic() + 5
+    while testFS.blockCache.dirtyBytes() > 8 * 1024 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert testFS.blockCache.dirtyBytes() <= 8 * 1024
+    testFS.unmount()
+
+    testFS = FileSystem.mount("testFlusher.dev")
+    assert testFS.open("a", "r").read() == bytes(len(testWrite))
+
+
+def test_write_back_unlocked():
+    FileSystem.createFileSystem("testWriteBack", 2048, 1024)
+    testFS = FileSystem.mount("testWriteBack.dev", cacheBytes=16 * 1024)
+    testFS.makeFile("a")
+    testWrite = bytes(i % 251 for i in range(12 * 1024))
+    testFS.open("a", "w").write(testWrite)
+    inWrite = threading.Event()
+    release = threading.Event()
+    timedOut = []
+    writeBlocks = testFS.rBlockDev.write_blocks
+
+    def slowWrite(*args):
+        inWrite.set()
+        if not release.wait(5):
+            timedOut.append(True)
+        return writeBlocks(*args)
+    testFS.rBlockDev.write_blocks = slowWrite
+    flush = threading.Thread(target=testFS.blockCache.flush, args=(testFS.rBlockDev,))
+    flush.start()
+    assert inWrite.wait(5)
+    # the cache is not locked while the device is busy
+    assert testFS.open("a", "r").read() == testWrite
+    release.set()
+    flush.join()
+    assert not timedOut, "the read waited for the write-back"
+    assert testFS.blockCache.dirtyBytes() == 0
+    testFS.unmount()
+
+
+def test_journal():
+    FileSystem.createFileSystem("testJournal", 2048, 1024)
+    testFS = FileSystem.mount("testJournal.dev")
+    journal = testFS.journal
+    assert testFS.masterBlock.journalBlockCount > 0
+    testFS.makeDir("d")
+    for i in range(40):
+        testFS.makeFile("d/f" + str(i))  # enough to move the directory out of its inode
+    testWrite = bytes(i % 251 for i in range(30 * 1024))
+    testFS.open("d/f7", "w").write(testWrite)
+    testFS.sync()
+    assert journal.commits == 1, "one sync is one transaction"
+    assert journal.nextBlock > 1
+
+    # crash: nothing but the journal records the metadata
+    testFS.rBlockDev.close()
+    testFS = FileSystem.mount("testJournal.dev")
+    assert testFS.journal.sequence == 2 and testFS.journal.nextBlock == 1
+    assert testFS.open("d/f7", "r").read() == testWrite
+    assert testFS.namei("d/f39")[0].isFile()
+
+    # a torn transaction is not replayed
+    testFS.makeFile("d/late")
+    testFS.sync()
+    testFS.makeFile("d/torn")
+    testFS.sync()
+    blockDev = testFS.rBlockDev
+    txn = bytearray(1024)
+    lastTxn = testFS.masterBlock.journalAddress + testFS.journal.nextBlock - 1
+    blockDev.read_block(lastTxn, txn)
+    assert txn[:4] == Journal.txn_magic
+    txn[struct.calcsize(Journal.txn_format) + 2] ^= 0xFF
+    blockDev.write_block(lastTxn, txn)
+    blockDev.close()
+    testFS = FileSystem.mount("testJournal.dev")
+    assert testFS.namei("d/late")[0].isFile()
+    assert testFS.namei("d/torn")[0] is None
+    testFS.unmount()
+
+
+def test_journal_mapped():
+    FileSystem.createFileSystem("testJournalMap", 2048, 1024)
+    testFS = FileSystem.mount("testJournalMap.dev", useMmap=True)
+    testFS.makeDir("d")
+    for i in range(40):
+        testFS.makeFile("d/f" + str(i))
+    testWrite = bytes(i % 251 for i in range(40 * 1024))
+    testFS.open("d/f3", "w").write(testWrite)
+    testFS.unmount()
+
+    testFS = FileSystem.mount("testJournalMap.dev", useMmap=True)
+    # not committed: new pointers in the existing pointer block, more
+    # directory entries
+    testFile = testFS.open("d/f3", "w")
+    testFile.seek(0, FileSeek.END)
+    testFile.write(testWrite)
+    testFS.makeFile("d/late")
+    testFS.rBlockDev.close()  # crash; the mapped image is all that is left
+
+    testFS = FileSystem.mount("testJournalMap.dev")
+    testInode = testFS.namei("d/f3")[0]
+    assert testInode.length == len(testWrite)
+    assert testFS.open("d/f3", "r").read() == testWrite
+    assert testFS.namei("d/late")[0] is None
+    # nothing points at a block that is free
+    for ptrBlock in [int(p) for p in testInode.blockPtrs if p]:
+        assert testFS.blockMap.blockMap[ptrBlock]
+        for ptr in testInode.blockToBlockPtrs(testFS.retrieveBlock(ptrBlock, metadata=True)):
+            assert ptr == 0 or testFS.blockMap.blockMap[int(ptr)], "pointer to free block " + str(ptr)
+    testFS.unmount()
+
+
+def test_journal_checkpoint():
+    FileSystem.createFileSystem("testCheckpoint", 2048, 1024)
+    testFS = FileSystem.mount("testCheckpoint.dev")
+    for i in range(200):
+        testFS.makeFile("f" + str(i))
+        testFS.sync()
+    assert testFS.journal.checkpoints > 0, "the journal was never emptied"
+    testFS.rBlockDev.close()
+    testFS = FileSystem.mount("testCheckpoint.dev")
+    assert all(testFS.namei("f" + str(i))[0].isFile() for i in range(200))
+    testFS.unmount()
+
+
+def test_journal_full():
+    FileSystem.createFileSystem("testJournalFull", 1024, 1024)
+    testFS = FileSystem.mount("testJournalFull.dev")
+    journal = testFS.journal
+    testFS.makeDir("d")
+    testFS.create_many("d", ["a" + str(i) for i in range(100)], "f")
+    testFS.sync()
+    # as if the journal were just too small for the next transaction
+    testFS.masterBlock.journalBlockCount = 2 * journal.nextBlock - 1
+    journalAddress = testFS.masterBlock.journalAddress
+    writeBlocks = testFS.rBlockDev.write_blocks
+
+    def crashingWrite(blockNums, *args):
+        if journal.checkpoints and blockNums and blockNums[0] > journalAddress and \
+                blockNums[0] < journalAddress + testFS.masterBlock.journalBlockCount:
+            raise OSError("crash while logging")
+        return writeBlocks(blockNums, *args)
+    testFS.rBlockDev.write_blocks = crashingWrite
+    try:
+        testFS.create_many("d", ["b" + str(i) for i in range(150)], "f")  # commits as it ends
+        testFS.sync()
+        assert False, "the transaction was not logged after the checkpoint"
+    except OSError:
+        pass
+    assert journal.checkpoints == 1
+    testFS.rBlockDev.close()
+
+    # the checkpoint put nothing but the first transaction in place
+    testFS = FileSystem.mount("testJournalFull.dev")
+    names = testFS.getDirectory(*testFS.namei("d")).get_children()
+    assert sorted(name for name in names if name not in (".", "..")) == sorted("a" + str(i) for i in range(100))
+    testFS.unmount()
+
+
+def test_journal_ordered():
+    FileSystem.createFileSystem("testJournalOrder", 2048, 1024)
+    testFS = FileSystem.mount("testJournalOrder.dev")
+    blockDev = testFS.rBlockDev
+    journalAddress = testFS.masterBlock.journalAddress
+    events = []
+    writeBlocks = blockDev.write_blocks
+    deviceSync = blockDev.sync
+
+    def recordedWrite(blockNums, *args):
+        inJournal = journalAddress < blockNums[0] < journalAddress + testFS.masterBlock.journalBlockCount
+        events.append("log" if inJournal else "write")
+        return writeBlocks(blockNums, *args)
+
+    def recordedSync():
+        events.append("sync")
+        return deviceSync()
+    blockDev.write_blocks = recordedWrite
+    blockDev.sync = recordedSync
+    testFS.makeFile("a")
+    testFS.open("a", "w").write(bytes(i % 251 for i in range(20 * 1024)))
+    testFS.sync()
+    # the data is durable before the transaction that points at it is written
+    logged = events.index("log")
+    lastWrite = max(i for i, event in enumerate(events[:logged]) if event == "write")
+    assert "sync" in events[lastWrite:logged]
+    testFS.unmount()
+
+
+def test_journal_operations():
+    FileSystem.createFileSystem("testJournalOps", 2048, 1024)
+    # a cache small enough that the metadata of one operation outgrows it
+    testFS = FileSystem.mount("testJournalOps.dev", cacheBytes=8 * 1024)
+    midOperation = []
+    commit = testFS.journal.commit
+
+    def checkedCommit():
+        midOperation.append(testFS.operations.readers > 0)
+        return commit()
+    testFS.journal.commit = checkedCommit
+    testFS.makeDir("d")
+    testFS.create_many("d", ["f" + str(i) for i in range(120)], "f")
+    testWrite = bytes(i % 251 for i in range(300 * 1024))
+    testFS.open("d/f5", "w").write(testWrite)
+    testFS.sync()
+    assert midOperation and not any(midOperation), "committed in the middle of an operation"
+    testFS.rBlockDev.close()
+
+    testFS = FileSystem.mount("testJournalOps.dev")
+    assert testFS.open("d/f5", "r").read() == testWrite
+    assert testFS.namei("d/f119")[0].isFile()
+    testFS.unmount()
+
+
+def test_namei_racing_create():
+    FileSystem.createFileSystem("testNameiRace", 2048, 1024)
+    testFS = FileSystem.mount("testNameiRace.dev")
+    testFS.makeDir("d")
+    inInsert = threading.Event()
+    made = threading.Event()
+    dentryInsert = testFS.dentryCache.insert
+
+    def slowInsert(parentNum, name, childNum):
+        # the lookup found nothing; give the create every chance to run now
+        if name == "new":
+            inInsert.set()
+            made.wait(0.5)
+        dentryInsert(parentNum, name, childNum)
+    testFS.dentryCache.insert = slowInsert
+
+    lookup = threading.Thread(target=testFS.namei, args=("d/new",))
+    lookup.start()
+    assert inInsert.wait(5)
+    create = threading.Thread(target=lambda: (testFS.makeFile("d/new"), made.set()))
+    create.start()
+    lookup.join()
+    create.join()
+    assert testFS.namei("d/new")[0] is not None, "stale negative dentry"
+    testFS.unmount()
+
+
+def test_concurrent_access():
+    FileSystem.createFileSystem("testThreads", 4096, 1024)
+    testFS = FileSystem.mount("testThreads.dev")
+    contents = {}
+    for n in range(6):
+        name = "f" + str(n)
+        testFS.makeFile(name)
+        contents[name] = bytes((i * (n + 1)) % 251 for i in range(48 * 1024 + n))
+        testFS.open(name, "w").write(contents[name])
+    testFS.unmount()
+
+    # a cache far smaller than the files, so the readers evict each other's blocks
+    testFS = FileSystem.mount("testThreads.dev", cacheBytes=32 * 1024)
+    errors = []
+
+    def reader(name):
+        try:
+            for rep in range(3):
+                testFile = testFS.open(name, "r")
+                got = b"".join(testFile.chunks(3000))
+                if got != contents[name]:
+                    errors.append(name + " read back wrong")
+        except Exception as e:
+            errors.append(repr(e))
+
+    def writer(n):
+        try:
+            name = "w" + str(n)
+            testFS.makeFile(name)
+            testFile = testFS.open(name, "w")
+            for i in range(40):
+                testFile.write(bytes([n]) * 1000)
+        except Exception as e:
+            errors.append(repr(e))
+
+    threads = [threading.Thread(target=reader, args=(name,)) for name in contents]
+    threads += [threading.Thread(target=writer, args=(n,)) for n in range(1, 4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    for n in range(1, 4):
+        assert testFS.open("w" + str(n), "r").read() == bytes([n]) * 40000
+    allocated = [testFS.namei("w" + str(n))[0].getDiskAddrOfBlock(i) for n in range(1, 4) for i in range(39)]
+    assert len(set(allocated)) == len(allocated), "two writers were given the same block"
+    testFS.unmount()
+
+    testFS = FileSystem.mount("testThreads.dev")
+    assert testFS.open("w2", "r").read() == bytes([2]) * 40000
+
+
+def test_merged_block_reads():
+    FileSystem.createFileSystem("testMerged", 2048, 1024)
+    testFS = FileSystem.mount("testMerged.dev")
+    testFS.makeFile("a")
+    testFS.open("a", "w").write(bytes(range(256)) * 16)
+    testFS.unmount()
+
+    testFS = FileSystem.mount("testMerged.dev")
+    blockNum = testFS.namei("a")[0].getDiskAddrOfBlock(2)
+    cache = testFS.blockCache
+    # another reader is reading the block; these have to wait for its read
+    fetch, mine = cache.claimFetch(blockNum)
+    assert mine
+    got = []
+    threads = [threading.Thread(target=lambda: got.append(testFS.retrieveBlock(blockNum))) for i in range(3)]
+    for t in threads:
+        t.start()
+    deadline = time.monotonic() + 5
+    while fetch.waiters < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert fetch.waiters == 3 and cache.mergedReads == 3 and got == []
+    block = bytearray(1024)
+    testFS.rBlockDev.read_block(blockNum, block)
+    assert cache.endFetch(blockNum, block) is block
+    for t in threads:
+        t.join()
+    assert len(got) == 3 and all(b is block for b in got)
+    assert blockNum not in cache.fetches
+
+    # a read straight into the caller's buffer leaves the waiters a copy
+    testFile = testFS.open("a", "r")
+    testRead = bytearray(1024)
+    testFile.seek(3 * 1024)
+    testFile.read(testRead)
+    assert testRead == bytes(range(256)) * 4
+    assert not cache.fetches
+    testFS.unmount()
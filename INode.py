@@ -1,6 +1,10 @@
 from FileSystem import *
+import FileSystem
 from enum import Enum
 import struct
+import threading
+from contextlib import contextmanager
+import numpy as np
 
 class INodeType(Enum):
     FREE = ord("O")
@@ -8,14 +12,86 @@ class INodeType(Enum):
     DIRECTORY = ord("d")
     SYMLINK = ord("s")
 
+class RWLock:
+    """
+    Many readers or one writer. A writer that is waiting holds off new
+    readers, so a steady stream of reads cannot starve it. A reader may
+    take the lock again for reading, and the writer for either.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = None  # the thread holding the lock for writing
+        self.writerDepth = 0
+        self.writersWaiting = 0
+        self.held = threading.local()  # readDepth: how often this thread holds it for reading
+
+    @contextmanager
+    def reading(self):
+        readDepth = getattr(self.held, "readDepth", 0)
+        if readDepth or self.writer == threading.get_ident():
+            self.held.readDepth = readDepth + 1
+            try:
+                yield
+            finally:
+                self.held.readDepth = readDepth
+            return
+        with self.cond:
+            while self.writer is not None or self.writersWaiting:
+                self.cond.wait()
+            self.readers += 1
+        self.held.readDepth = 1
+        try:
+            yield
+        finally:
+            self.held.readDepth = 0
+            with self.cond:
+                self.readers -= 1
+                if self.readers == 0:
+                    self.cond.notify_all()
+
+    @contextmanager
+    def writing(self):
+        me = threading.get_ident()
+        with self.cond:
+            if self.writer != me:
+                self.writersWaiting += 1
+                while self.writer is not None or self.readers:
+                    self.cond.wait()
+                self.writersWaiting -= 1
+                self.writer = me
+            self.writerDepth += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.writerDepth -= 1
+                if self.writerDepth == 0:
+                    self.writer = None
+                    self.cond.notify_all()
+
+    def isHeld(self):
+        """ whether the calling thread holds the lock, for reading or writing """
+        return getattr(self.held, "readDepth", 0) > 0 or self.writer == threading.get_ident()
+
+
 class INode:
     # Inode Constants
     Num_Block_Ptrs = 26
+    Inode_Size = 128  # bytes taken by a packed inode in the inode table (see toBytes)
+    Flags_Offset = 10  # where the flags byte is in a packed inode
+    Inline_Size = Num_Block_Ptrs * 4  # bytes of data an inline inode holds instead of block pointers
+    Iflags_Offset = 126  # where the iflags byte is in a packed inode
+    Iflag_Inline = 0x01  # the data is in the inode (format_inline_data and later)
+    Addr_Memo_Size = 1024  # most disk addresses an inode remembers, see getDiskAddrOfBlock
     default_date = 777
     default_flags_inode = INodeType.FREE
     default_perms = 777
     default_level = 0
-    default_length = 2048
+    default_length = 0
+    Max_Length = 2**31 - 1  # length packed as a signed 32 bit int, before format_wide_length
+    Max_Wide_Length = 2**63 - 1  # and as a signed 64 bit int since
     default_MagicNumber = 5000
 
     def __init__(self, parentFS,
@@ -37,6 +113,21 @@ class INode:
         self.magicNumber = magicNumber # 32 bits
         self.blockPtrs = [0] * INode.Num_Block_Ptrs  # 28 x 32bits
         self.ptrsPerBlock = self.masterBlock.blockSize // 4
+        self.dirty = False  # on-disk copy out of date, see InodeMap.sync
+        # data blocks allocated ahead by write (see allocDataBlock)
+        self.extentNext = 0
+        self.extentRemaining = 0
+        self.extentWanted = 1
+        self.lastDataBlock = 0
+        self.blockAddrs = {}  # logical block -> disk block, see getDiskAddrOfBlock
+        # sequential read detection, see readAheadAddrs
+        self.readAheadLock = threading.Lock()  # readers share self.lock, so this guards the next three
+        self.lastReadEnd = 0
+        self.readAheadWindow = 0
+        self.readAheadEnd = 0
+        self.inline = False  # data kept in inlineData rather than in blocks
+        self.inlineData = bytearray(INode.Inline_Size)
+        self.lock = RWLock()  # taken by read and seek* for reading, by write, truncate and punchHole for writing
 
     ########### Exported functions
 
@@ -56,31 +147,65 @@ class INode:
         :param buffer:      read up to len(buffer) bytes into this buffer
         :return:            number of bytes successfully read
         """
-        startingOffset = file_offset
-        offset = file_offset
-        endOffset = startingOffset + len(buffer)
-        bp = 0
-        #print("reead~; length: " + str(self.length) + "." )
-        while endOffset-offset != 0:
-            #print("endOf: " + str(endOffset) + " ; offset: " + str(offset))
-            blockIndex = offset // self.masterBlock.blockSize
-            readIndex = blockIndex*self.masterBlock.blockSize
-            startWriteAt = 0
-            restOfBlock = self.masterBlock.blockSize
-            if readIndex < startingOffset:
-                startWriteAt = startingOffset-readIndex
-            if (readIndex + self.masterBlock.blockSize) > endOffset:
-                restOfBlock = endOffset - readIndex
-            dataBlockAddr = self.getDiskAddrOfBlock(blockIndex, False)
-            dataBlock = self.parentFS.retrieveBlock(dataBlockAddr)
-            for i in range(restOfBlock-startWriteAt):
-                buffer[bp*self.masterBlock.blockSize + i] = dataBlock[startWriteAt + i]
-            #print("pre-cache")
-            self.parentFS.cacheBlock(dataBlockAddr,dataBlock)
-            offset = offset + (restOfBlock-startWriteAt)
-            bp += 1
-
-        #print("Reading from inode: " + str(self.inodeNum) + " with msg: " + str(buffer.decode("utf-8")) + " |||")
+        with self.lock.reading():
+            dst = memoryview(buffer).cast("B")
+            blockSize = self.masterBlock.blockSize
+            startingOffset = file_offset
+            endOffset = startingOffset + len(dst)
+            if endOffset == startingOffset:
+                return 0
+            if self.inline:
+                end = min(endOffset, INode.Inline_Size)
+                dst[:max(end - startingOffset, 0)] = self.inlineData[startingOffset:end]
+                dst[max(end - startingOffset, 0):] = bytes(endOffset - max(end, startingOffset))
+                return len(dst)
+            # look up every block of the request first, so the uncached ones
+            # can be fetched from the device in one batch
+            firstBlock = startingOffset // blockSize
+            lastBlock = (endOffset - 1) // blockSize
+            dataBlockAddrs = [self.getDiskAddrOfBlock(i, False) for i in range(firstBlock, lastBlock + 1)]
+            # whole blocks that are not cached are read straight into the
+            # caller's buffer, the rest is copied out of the cached blocks
+            mapped = self.parentFS.viewsBlocks(self.isDirectory())
+            directAddrs, directBuffs, copies = [], [], []
+            bp = 0
+            for i, dataBlockAddr in enumerate(dataBlockAddrs):
+                blockStart = (firstBlock + i) * blockSize
+                start = max(startingOffset - blockStart, 0)
+                end = min(endOffset - blockStart, blockSize)
+                if dataBlockAddr <= 0:
+                    dst[bp:bp + end - start] = bytes(end - start)  # a hole
+                elif end - start == blockSize and not mapped and self.parentFS.blockCache.claimUncached(dataBlockAddr):
+                    directAddrs.append(dataBlockAddr)
+                    directBuffs.append(dst[bp:bp + blockSize])
+                else:
+                    copies.append((dataBlockAddr, start, end, bp))
+                bp += end - start
+            blockCache = self.parentFS.blockCache
+            aheadAddrs = []
+            if not mapped:
+                aheadAddrs = [addr for addr in self.readAheadAddrs(startingOffset, endOffset)
+                              if blockCache.claimUncached(addr)]
+            aheadBuffs = [bytearray(blockSize) for b in aheadAddrs]
+            # the direct and read-ahead blocks are claimed (see BlockCache.claimFetch),
+            # so other readers of them wait for this read
+            try:
+                if directAddrs or aheadAddrs:
+                    self.parentFS.rBlockDev.read_blocks(directAddrs + aheadAddrs, directBuffs + aheadBuffs)
+            except BaseException:
+                for addr in directAddrs + aheadAddrs:
+                    blockCache.endFetch(addr, None)
+                raise
+            for directAddr, directBuff in zip(directAddrs, directBuffs):
+                blockCache.endFetch(directAddr, directBuff, cache=False)
+            for aheadAddr, aheadBuff in zip(aheadAddrs, aheadBuffs):
+                blockCache.endFetch(aheadAddr, aheadBuff)
+            with blockCache.lock:
+                blockCache.readAheads += len(aheadAddrs)
+            dataBlocks = self.parentFS.retrieveBlocks([c[0] for c in copies], metadata=self.isDirectory())
+            for (dataBlockAddr, start, end, bp), dataBlock in zip(copies, dataBlocks):
+                dst[bp:bp + end - start] = dataBlock[start:end]
+            return len(dst)
 
     # TODO: Assignment 3.2
     #     Similarly tricky as read, except when you look up blocks, pass the
@@ -94,48 +219,176 @@ class INode:
         :param buffer:       write these bytes to the file
         :return:             number of bytes written
         """
-        #print("Writing to inode: " + str(self.inodeNum) + " with msg: " + str(buffer.decode("utf-8")) + " |||")
-        startingOffset = file_offset
-        offset = file_offset
-        endOffset = startingOffset + len(buffer)
-        bp = 0
-
-        while endOffset-offset != 0:
-            blockIndex = offset // self.masterBlock.blockSize
-            readIndex = blockIndex*self.masterBlock.blockSize
-            startWriteAt = 0
-            restOfBlock = self.masterBlock.blockSize
-            if readIndex < startingOffset:
-                startWriteAt = startingOffset-readIndex
-            if (readIndex + self.masterBlock.blockSize) > endOffset:
-                restOfBlock = endOffset - readIndex
-            dataBlockAddr = self.getDiskAddrOfBlock(blockIndex, True)
-            dataBlock = self.parentFS.retrieveBlock(dataBlockAddr)
-            for i in range(restOfBlock-startWriteAt):
-                dataBlock[startWriteAt + i] = buffer[bp*self.masterBlock.blockSize + i]
-            self.parentFS.cacheBlock(dataBlockAddr,dataBlock)
-            offset = offset + (restOfBlock-startWriteAt)
-            bp += 1
+        with self.parentFS.operation(), self.lock.writing():
+            src = memoryview(buffer).cast("B")
+            blockSize = self.masterBlock.blockSize
+            startingOffset = file_offset
+            endOffset = startingOffset + len(src)
+            if endOffset == startingOffset:
+                return 0
+            if endOffset > self.maxLength():
+                print("Error: INode.write: past the largest possible inode")
+                return 0
+            if self.inline:
+                if endOffset <= INode.Inline_Size:
+                    self.inlineData[startingOffset:endOffset] = src
+                    self.length = max(self.length, endOffset)
+                    self.markDirty()
+                    return len(src)
+                self.moveInlineData()
+            firstBlock = startingOffset // blockSize
+            lastBlock = (endOffset - 1) // blockSize
+            # writing past the end grows the inode, and the pointer tree with it
+            oldLength = self.length
+            if endOffset > self.length:
+                self.length = endOffset
+                self.markDirty()
+            if not self.grow(lastBlock + 1):
+                self.length = oldLength
+                return 0
+            dataBlockAddrs = []
+            freshAddrs = set()
+            for i in range(firstBlock, lastBlock + 1):
+                dataBlockAddr = self.getDiskAddrOfBlock(i, False)
+                if dataBlockAddr == 0:
+                    # the first missing block of the write allocates an extent
+                    # for the rest of it
+                    self.extentWanted = lastBlock - i + 1
+                    dataBlockAddr = self.getDiskAddrOfBlock(i, True)
+                    freshAddrs.add(dataBlockAddr)
+                if dataBlockAddr <= 0:
+                    # the disk is full: write what has a block, and no more
+                    freshAddrs.discard(dataBlockAddr)
+                    endOffset = max(i * blockSize, startingOffset)
+                    self.length = max(oldLength, endOffset)
+                    break
+                dataBlockAddrs.append(dataBlockAddr)
+            self.releaseExtent()
+            if endOffset == startingOffset:
+                return 0
+
+            # a block the write covers completely does not need its old contents,
+            # so unless it is cached (or a free view of the mapped device) it is
+            # cached as a fresh copy of the caller's data instead of being read.
+            # A block that was a hole starts out as zeros.
+            mapped = self.parentFS.viewsBlocks(self.isDirectory())
+            spans = []
+            bp = 0
+            for i, dataBlockAddr in enumerate(dataBlockAddrs):
+                blockStart = (firstBlock + i) * blockSize
+                start = max(startingOffset - blockStart, 0)
+                end = min(endOffset - blockStart, blockSize)
+                spans.append((dataBlockAddr, start, end, bp))
+                bp += end - start
+            needed = [addr for addr, start, end, bp in spans if mapped or (addr not in freshAddrs and
+                      (end - start < blockSize or addr in self.parentFS.blockCache))]
+            dataBlocks = dict(zip(needed, self.parentFS.retrieveBlocks(needed, metadata=self.isDirectory())))
+            for dataBlockAddr, start, end, bp in spans:
+                dataBlock = dataBlocks.get(dataBlockAddr)
+                if dataBlock is not None and dataBlockAddr in freshAddrs:
+                    dataBlock[:start] = bytes(start)
+                    dataBlock[end:] = bytes(blockSize - end)
+                if dataBlock is None and end - start == blockSize:
+                    dataBlock = bytearray(src[bp:bp + blockSize])
+                elif dataBlock is None:
+                    dataBlock = bytearray(blockSize)
+                    dataBlock[start:end] = src[bp:bp + end - start]
+                else:
+                    dataBlock[start:end] = src[bp:bp + end - start]
+                self.parentFS.cacheBlock(dataBlockAddr, dataBlock)
+                if self.isDirectory():
+                    self.parentFS.markMetadata(dataBlockAddr, dataBlockAddr in freshAddrs)
+            return endOffset - startingOffset
 
-        pass
+    def readAheadAddrs(self, startingOffset, endOffset):
+        """
+        A read that starts where the last one ended is sequential, and
+        doubles the read-ahead window, up to parentFS.readAhead blocks;
+        any other read closes it. Once a sequential reader gets within half
+        a window of the blocks read ahead so far, the next window's worth
+        is read ahead, along with the read itself.
+        :return: disk addresses of the uncached blocks to read ahead
+        """
+        blockSize = self.masterBlock.blockSize
+        maxWindow = min(self.parentFS.readAhead, self.parentFS.blockCache.capacity() // 4)
+        with self.readAheadLock:
+            if startingOffset == self.lastReadEnd:
+                self.readAheadWindow = min(max(2 * self.readAheadWindow, 4), maxWindow)
+            else:
+                self.readAheadWindow = 0
+                self.readAheadEnd = 0
+            self.lastReadEnd = endOffset
+            nextBlock = -(-endOffset // blockSize)
+            if self.readAheadWindow == 0 or nextBlock + self.readAheadWindow // 2 < self.readAheadEnd:
+                return []
+            first = max(nextBlock, self.readAheadEnd)
+            last = min(nextBlock + self.readAheadWindow, -(-self.length // blockSize))
+            self.readAheadEnd = max(last, self.readAheadEnd)
+        aheadAddrs = [self.getDiskAddrOfBlock(i, False) for i in range(first, last)]
+        return [addr for addr in aheadAddrs if addr > 0 and addr not in self.parentFS.blockCache]
+
+    def allocDataBlock(self):
+        """
+        allocate a data block, from the extent reserved by the current write
+        if there is one left, otherwise reserve a new extent of
+        extentWanted blocks, next to the last data block we allocated
+        """
+        if self.extentRemaining == 0:
+            near = None
+            if self.lastDataBlock != 0:
+                near = self.lastDataBlock + 1
+            start, count = self.parentFS.allocExtent(self.extentWanted, near)
+            if start == -1:
+                return -1
+            self.extentNext, self.extentRemaining = start, count
+        blockNum = self.extentNext
+        self.extentNext += 1
+        self.extentRemaining -= 1
+        self.lastDataBlock = blockNum
+        return blockNum
+
+    def releaseExtent(self):
+        """ give the unused part of the reserved extent back to the BlockMap """
+        for blockNum in range(self.extentNext, self.extentNext + self.extentRemaining):
+            self.parentFS.freeBlock(blockNum)
+        self.extentRemaining = 0
+        self.extentWanted = 1
 
     # isFile and isDirectory help clients of the API not need to know about
     # our enum type.
 
     # create an array of block pointers from a data block (assumes data block is meant to be block of pointers)
+    # (into a block just allocated for them)
     def writeBlockOfPtrs(self,blockNum,ptrsToPack):
-        blockOfPtrs = bytearray(0)
-        for x in range(0,self.ptrsPerBlock):
-            blockOfPtrs.extend(struct.pack("=i", ptrsToPack[x]))
+        blockOfPtrs = bytearray(np.asarray(ptrsToPack[:self.ptrsPerBlock], dtype=np.int32).tobytes())
         #print("writing block of pointers at: " + str(blockNum))
         self.parentFS.cacheBlock(blockNum,blockOfPtrs)
+        self.parentFS.markMetadata(blockNum, True)
         return
 
     def blockToBlockPtrs(self,blockOfPtrs):
-        retPtrArray = [0] * self.ptrsPerBlock
-        for x in range(0,self.ptrsPerBlock):
-            (retPtrArray[x],) = struct.unpack("=i", blockOfPtrs[4*x:4*x+4])
-        return retPtrArray
+        """ the pointers in a block of pointers, as an array over the block
+            itself: nothing is decoded, and setting an entry changes the block
+        """
+        return np.frombuffer(blockOfPtrs, dtype=np.int32)
+
+    def setBlockPtr(self, blocks, index, blockNum, blocksBlockPtr):
+        """
+        Point entry index of a pointer array at blockNum
+        :param blocks:         the inode's blockPtrs, or a view from blockToBlockPtrs
+        :param blocksBlockPtr: the block that view is over, 0 for blockPtrs
+        """
+        blocks[index] = blockNum
+        if blocksBlockPtr == 0:
+            self.markDirty()
+        else:
+            # the block the view is over may have been evicted since it was
+            # retrieved; caching that very block keeps the change either way
+            block = blocks.base
+            if isinstance(block, memoryview) and isinstance(block.obj, bytearray):
+                block = block.obj
+            self.parentFS.cacheBlock(blocksBlockPtr, block)
+            self.parentFS.markMetadata(blocksBlockPtr)
 
     def isFile(self):
         return self.flags == INodeType.FILE
@@ -149,14 +402,195 @@ class INode:
         return chars[self.flags.value]
 
     def truncate(self, len):
-        # TODO  Perserve existing block pointers when inode length increased
-        # TODO: mark any allocated blocks in the truncated range
-        #       as free if we shorten the inode
-        #print("truncating")
-        self.length = len
+        """
+        Set the length of the inode. Blocks past a shorter length are freed,
+        and growing the inode leaves a hole, which reads as zeros.
+        """
+        with self.parentFS.operation(), self.lock.writing():
+            #print("truncating")
+            if len > self.maxLength():
+                print("Error: INode.truncate: past the largest possible inode")
+                return
+            if self.inline and len > INode.Inline_Size:
+                self.moveInlineData()
+            if self.inline:
+                self.inlineData[len:] = bytes(max(INode.Inline_Size - len, 0))
+            elif len < self.length:
+                blockSize = self.masterBlock.blockSize
+                if len % blockSize != 0:
+                    self.zeroBlockRange(len // blockSize, len % blockSize, blockSize)
+                self.freeBlockRange(-(-len // blockSize), self.blockCapacity())
+            if len == 0:
+                self.level = 0  # nothing is left in the pointer tree
+                self.inline = self.canInline()
+            self.length = len
+            self.markDirty()
+
+    def punchHole(self, offset, length):
+        """
+        Turn length bytes at offset into a hole: whole blocks in the range
+        are freed, the ends of partly covered blocks are zeroed. The length
+        of the inode does not change.
+        """
+        with self.parentFS.operation(), self.lock.writing():
+            blockSize = self.masterBlock.blockSize
+            end = min(offset + length, self.length)
+            if end <= offset:
+                return
+            if self.inline:
+                self.inlineData[offset:end] = bytes(end - offset)
+                self.markDirty()
+                return
+            firstWhole = -(-offset // blockSize)
+            lastWhole = end // blockSize
+            if end == self.length:
+                # the tail of the last block is past the end of the inode anyway
+                lastWhole = -(-end // blockSize)
+                end = lastWhole * blockSize
+            if firstWhole > lastWhole:  # inside a single block
+                self.zeroBlockRange(offset // blockSize, offset % blockSize, end - lastWhole * blockSize)
+                return
+            if offset % blockSize != 0:
+                self.zeroBlockRange(offset // blockSize, offset % blockSize, blockSize)
+            if end % blockSize != 0:
+                self.zeroBlockRange(lastWhole, 0, end % blockSize)
+            self.freeBlockRange(firstWhole, lastWhole)
+
+    def seekData(self, offset):
+        """ the first offset >= offset that is not in a hole, -1 if there is none """
+        with self.lock.reading():
+            blockSize = self.masterBlock.blockSize
+            if self.inline:
+                return offset if offset < self.length else -1
+            for i in range(offset // blockSize, -(-self.length // blockSize)):
+                if self.getDiskAddrOfBlock(i, False) > 0:
+                    return max(offset, i * blockSize)
+            return -1
+
+    def seekHole(self, offset):
+        """ the first offset >= offset in a hole, the end of the inode counts
+            as one; -1 if offset is past the end
+        """
+        with self.lock.reading():
+            blockSize = self.masterBlock.blockSize
+            if offset >= self.length:
+                return -1
+            if self.inline:
+                return self.length
+            for i in range(offset // blockSize, -(-self.length // blockSize)):
+                if self.getDiskAddrOfBlock(i, False) == 0:
+                    return max(offset, i * blockSize)
+            return self.length
+
+    def reset(self):
+        """ empty a newly allocated inode of whatever its last user left in it """
+        self.level = INode.default_level
+        self.length = INode.default_length
+        self.blockPtrs = [0] * INode.Num_Block_Ptrs
+        self.blockAddrs = {}
+        self.inline = self.canInline()
+        self.inlineData = bytearray(INode.Inline_Size)
+        self.extentNext = 0
+        self.extentRemaining = 0
+        self.extentWanted = 1
+        self.lastDataBlock = 0
+
+    def maxLength(self):
+        """ the largest length this file system's inode format can hold """
+        if self.masterBlock.formatVersion >= FileSystem.format_wide_length:
+            return INode.Max_Wide_Length
+        return INode.Max_Length
+
+    def canInline(self):
+        """ whether this file system keeps small inodes' data inline """
+        return self.masterBlock.formatVersion >= FileSystem.format_inline_data
+
+    def moveInlineData(self):
+        """ move the data of an inline inode out to a block, as it outgrows the inode """
+        data = bytes(self.inlineData[:self.length])
+        self.inline = False
+        self.inlineData = bytearray(INode.Inline_Size)
+        self.markDirty()
+        if data:
+            self.write(data, 0)
+
+    def markDirty(self):
+        self.parentFS.inodeMap.markInodeDirty(self)
 
     ########### Internal functions
 
+    def blockCapacity(self):
+        """ how many blocks the pointer tree of this inode can address """
+        return INode.Num_Block_Ptrs * self.ptrsPerBlock**self.level
+
+    def grow(self, blockCount):
+        """
+        Add levels to the pointer tree until it can address blockCount
+        blocks. Each new level moves the top block pointers into a new block
+        of pointers, which becomes the first top pointer, so nothing else
+        has to be copied.
+        :return: False if there was no block for the pointers
+        """
+        while self.blockCapacity() < blockCount:
+            if any(self.blockPtrs):
+                ptrBlock = self.parentFS.allocBlock()
+                if ptrBlock == -1:
+                    print("Error: INode.grow: no free block for block pointers")
+                    return False
+                self.writeBlockOfPtrs(ptrBlock, self.blockPtrs + [0] * (self.ptrsPerBlock - INode.Num_Block_Ptrs))
+                self.blockPtrs = [ptrBlock] + [0] * (INode.Num_Block_Ptrs - 1)
+            self.level += 1
+            self.markDirty()
+        return True
+
+    def zeroBlockRange(self, blockIndex, start, end):
+        """ zero bytes [start, end) of block blockIndex, unless it is a hole """
+        dataBlockAddr = self.getDiskAddrOfBlock(blockIndex, False)
+        if dataBlockAddr > 0:
+            dataBlock = self.parentFS.retrieveBlock(dataBlockAddr, metadata=self.isDirectory())
+            dataBlock[start:end] = bytes(end - start)
+            self.parentFS.cacheBlock(dataBlockAddr, dataBlock)
+            if self.isDirectory():
+                self.parentFS.markMetadata(dataBlockAddr)
+
+    def freeBlockRange(self, first, last):
+        """ free the data blocks of blocks [first, last), leaving holes """
+        if first >= last:
+            return
+        self.freeBlocks_recursive(first, last, self.blockPtrs, self.level, 0)
+        self.blockAddrs = {b: addr for b, addr in self.blockAddrs.items() if not first <= b < last}
+
+    def freeBlocks_recursive(self, first, last, blocks, level, blocksBlockPtr):
+        """
+        Helper for freeBlockRange, works like getDiskAddrOfBlock_recursive.
+        A pointer block left with no pointers in it is freed as well.
+        """
+        ptrsPerPtr = self.ptrsPerBlock**level
+        for i in range(first // ptrsPerPtr, min(-(-last // ptrsPerPtr), len(blocks))):
+            if blocks[i] == 0:
+                continue
+            childBlock = int(blocks[i])
+            start = max(first - i * ptrsPerPtr, 0)
+            end = min(last - i * ptrsPerPtr, ptrsPerPtr)
+            if level > 0 and (start > 0 or end < ptrsPerPtr):
+                childPtrs = self.blockToBlockPtrs(self.parentFS.retrieveBlock(childBlock, metadata=True))
+                self.freeBlocks_recursive(start, end, childPtrs, level - 1, childBlock)
+                if childPtrs.any():
+                    continue
+            else:
+                self.freeSubtree(childBlock, level)
+            self.parentFS.freeBlock(childBlock)
+            self.setBlockPtr(blocks, i, 0, blocksBlockPtr)
+
+    def freeSubtree(self, blockNum, level):
+        """ free everything below pointer block blockNum of the given level """
+        if level == 0:
+            return
+        for ptr in self.blockToBlockPtrs(self.parentFS.retrieveBlock(blockNum, metadata=True)):
+            if ptr != 0:
+                self.freeSubtree(int(ptr), level - 1)
+                self.parentFS.freeBlock(int(ptr))
+
     def getDiskAddrOfBlock(self, block_number, alloc=False):
         """
         Get the disk address of <block_number> in this INode
@@ -168,7 +602,26 @@ class INode:
         if block_number*self.masterBlock.blockSize > self.length:
             print("Error: getDiskAddrOfBlock: read past size of inode")
             return -1
-        return self.getDiskAddrOfBlock_recursive(block_number, alloc, self.blockPtrs, self.level,0)
+        if self.inline:
+            if not alloc:
+                return 0
+            self.moveInlineData()
+        if block_number >= self.blockCapacity():
+            if not alloc:
+                return 0
+            if not self.grow(block_number + 1):
+                return -1
+        # remembered, so walking the pointer blocks is mostly paid once per
+        # block; forgotten all at once when full, so a big file's addresses
+        # never all stay in memory
+        diskAddr = self.blockAddrs.get(block_number)
+        if diskAddr is None:
+            diskAddr = self.getDiskAddrOfBlock_recursive(block_number, alloc, self.blockPtrs, self.level,0)
+            if diskAddr > 0:
+                if len(self.blockAddrs) >= INode.Addr_Memo_Size:
+                    self.blockAddrs.clear()
+                self.blockAddrs[block_number] = diskAddr
+        return diskAddr
 
     # TODO: Assignment 3.1
     #     Start by considering just level 0 (the blocks array is an array of block addresses)
@@ -185,7 +638,7 @@ class INode:
         :param alloc:        whether we should allocate if the sought block is missing
         :param blocks:       the block array at this level
         :param level:        the distance from the leaves of the block pointer tree
-        :return:             -1 if alloc is false and block is missing, otherwise the disk block address
+        :return:             0 if alloc is false and the block is a hole, otherwise the disk block address
                                 corresponding to this INode's data @ block_number
         """
 
@@ -194,14 +647,12 @@ class INode:
             if len(blocks) <= blockNumber:
                print("Error: getDiskAddrOfBlock: attempted access beyond inode size")
                return -1
-            if blocks[blockNumber] == 0:
-                blocks[blockNumber] = self.parentFS.allocBlock()
-                if (blocksBlockPtr == 0):
-                    self.blockPtrs = blocks  # top level inode blocks
-                else:
-                    self.writeBlockOfPtrs(blocksBlockPtr,blocks)
-                return blocks[blockNumber]
-            return blocks[blockNumber]
+            if blocks[blockNumber] == 0 and alloc:
+                newBlock = self.allocDataBlock()
+                if newBlock == -1:
+                    return -1
+                self.setBlockPtr(blocks, blockNumber, newBlock, blocksBlockPtr)
+            return int(blocks[blockNumber])
 
         ptrsPerPtr = self.ptrsPerBlock**level
         newBlockIndex = blockNumber//ptrsPerPtr
@@ -211,42 +662,57 @@ class INode:
             print("Error: getDiskAddrOfBlock: attempted access beyond inode size")
             return -1
 
-        newBlocks = None
-
         if(blocks[newBlockIndex] == 0): #if no block pointer, allocate block
-            blocks[newBlockIndex] = self.parentFS.allocBlock()
-            #update blocks since is given a new blockptr
-            if(blocksBlockPtr == 0):
-                self.blockPtrs = blocks #top level inode blocks
-            else:
-                self.writeBlockOfPtrs(blocksBlockPtr,blocks)
-            newBlocks = [0]*self.ptrsPerBlock
-            self.writeBlockOfPtrs(blocks[newBlockIndex],newBlocks)
-        else:
-            newBlocks = self.blockToBlockPtrs(self.parentFS.retrieveBlock(blocks[newBlockIndex],True))
-        return self.getDiskAddrOfBlock_recursive(newBlockNumber,alloc,newBlocks,level-1,blocks[newBlockIndex])
+            if not alloc:
+                return 0
+            newBlock = self.parentFS.allocBlock()
+            if newBlock == -1:
+                return -1
+            self.setBlockPtr(blocks, newBlockIndex, newBlock, blocksBlockPtr)
+            self.writeBlockOfPtrs(int(blocks[newBlockIndex]), [0] * self.ptrsPerBlock)
+        newBlockPtr = int(blocks[newBlockIndex])
+        newBlocks = self.blockToBlockPtrs(self.parentFS.retrieveBlock(newBlockPtr, metadata=True))
+        return self.getDiskAddrOfBlock_recursive(newBlockNumber,alloc,newBlocks,level-1,newBlockPtr)
 
         pass
 
-    def pack(self, blockDev, blockNum):
+    def toBytes(self):
         """
-        we store all 28 inode block pointers with a for loop
+        we store all 26 inode block pointers with a for loop, or the data
+        itself for an inline inode, and the iflags byte at Iflags_Offset.
+        Since format_wide_length the length is 64 bits, the high half where
+        the magic number was.
         """
-        inodeBytes = bytearray(struct.pack("=hiibhbii",
-                                           self.inodeNum,
-                                           self.cdate,
-                                           self.mdate,
-                                           self.flags.value,
-                                           self.perms,
-                                           self.level,
-                                           self.length,
-                                           self.magicNumber))
-
-        for x in range(26):
-            inodeBytes.extend(struct.pack("=i", self.blockPtrs[x]))
-        blockDev.write_block(blockNum, inodeBytes, True)
+        if self.masterBlock.formatVersion >= FileSystem.format_wide_length:
+            inodeBytes = bytearray(struct.pack("=hiibhbq",
+                                               self.inodeNum,
+                                               self.cdate,
+                                               self.mdate,
+                                               self.flags.value,
+                                               self.perms,
+                                               self.level,
+                                               self.length))
+        else:
+            inodeBytes = bytearray(struct.pack("=hiibhbii",
+                                               self.inodeNum,
+                                               self.cdate,
+                                               self.mdate,
+                                               self.flags.value,
+                                               self.perms,
+                                               self.level,
+                                               self.length,
+                                               self.magicNumber))
+
+        if self.inline:
+            inodeBytes.extend(self.inlineData)
+        else:
+            for x in range(26):
+                inodeBytes.extend(struct.pack("=i", self.blockPtrs[x]))
+        iflags = INode.Iflag_Inline if self.inline else 0
+        inodeBytes.extend(struct.pack("=BB", iflags, 0))
+        return inodeBytes
 
-    def unpack(self, blockDev, blockNum):
+    def fromBytes(self, inodeBytes):
         """
         on unpack (as part of unmount) we must update our masterblock reference and inital blockmap size
 
@@ -254,19 +720,42 @@ class INode:
         """
         self.masterBlock = self.parentFS.masterBlock
         self.ptrsPerBlock = self.masterBlock.blockSize // 4
-        inodeBytes = bytearray(self.masterBlock.blockSize)
-        blockDev.read_block(blockNum, inodeBytes)
-
-        (self.inodeNum,
-         self.cdate,
-         self.mdate,
-         flagVal,
-         self.perms,
-         self.level,
-         self.length,
-         self.magicNumber) = struct.unpack("=hiibhbii", inodeBytes[:22])
+        self.blockAddrs = {}
+
+        if self.masterBlock.formatVersion >= FileSystem.format_wide_length:
+            (self.inodeNum,
+             self.cdate,
+             self.mdate,
+             flagVal,
+             self.perms,
+             self.level,
+             self.length) = struct.unpack("=hiibhbq", inodeBytes[:22])
+        else:
+            (self.inodeNum,
+             self.cdate,
+             self.mdate,
+             flagVal,
+             self.perms,
+             self.level,
+             self.length,
+             self.magicNumber) = struct.unpack("=hiibhbii", inodeBytes[:22])
 
         self.flags = INodeType(flagVal)
 
-        for x in range(26):
-            (self.blockPtrs[x],) = struct.unpack("=i", inodeBytes[22 + x * 4:22 + (x + 1) * 4:])
\ No newline at end of file
+        self.inline = bool(inodeBytes[INode.Iflags_Offset] & INode.Iflag_Inline)
+        if self.inline:
+            self.inlineData = bytearray(inodeBytes[22:22 + INode.Inline_Size])
+            self.blockPtrs = [0] * INode.Num_Block_Ptrs
+        else:
+            self.inlineData = bytearray(INode.Inline_Size)
+            for x in range(26):
+                (self.blockPtrs[x],) = struct.unpack("=i", inodeBytes[22 + x * 4:22 + (x + 1) * 4:])
+        self.dirty = False
+
+    def pack(self, blockDev, blockNum):
+        blockDev.write_block(blockNum, self.toBytes(), True)
+
+    def unpack(self, blockDev, blockNum):
+        inodeBytes = bytearray(self.parentFS.masterBlock.blockSize)
+        blockDev.read_block(blockNum, inodeBytes)
+        self.fromBytes(inodeBytes)
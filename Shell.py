@@ -61,10 +61,14 @@ def repl():
             else:
                 fileSys.writeFile(words[1]," ".join(words[3:]), int(words[2]))
         elif words[0] == 'mkdir':
-            if numWords != 2:
-                print("Error: mkdir - requires one argument: 'mkdir <dirName>'")
+            if numWords < 2 or numWords > 3 or (numWords == 3 and words[2] not in ('text', 'hashed')):
+                print("Error: mkdir - requires one or two arguments: 'mkdir <dirName> [text|hashed]'")
             elif fileSys is None:
                 print("Error: mkdir - a fileSys must be mounted first '")
+            elif numWords == 3 and words[2] == 'hashed':
+                fileSys.makeDir(words[1], FileSystem.dir_format_hashed)
+            elif numWords == 3:
+                fileSys.makeDir(words[1], FileSystem.dir_format_text)
             else:
                 fileSys.makeDir(words[1])
         elif words[0] == 'touch':
@@ -74,6 +78,16 @@ def repl():
                 print("Error: touch - a fileSys must be mounted first '")
             else:
                 fileSys.makeFile(words[1])
+        elif words[0] == 'create_many':
+            # creates many files or dirs in one directory ('.' is the current one)
+            if numWords < 4 or words[1] not in ('f', 'd'):
+                print("Error: create_many - requires three or more arguments: 'create_many <f|d> <dirPath> <name> [name ...]'")
+            elif fileSys is None:
+                print("Error: create_many - a fileSys must be mounted first '")
+            elif words[2] == '.':
+                fileSys.create_many(None, words[3:], words[1])
+            else:
+                fileSys.create_many(words[2], words[3:], words[1])
         elif words[0] == 'cd':
             if numWords != 2:
                 print("Error: cd - requires one argument: 'cd <path>'")
@@ -85,12 +99,18 @@ def repl():
             print(*words[1:]," ")
         elif words[0] == 'newfs':
             # Creates a file system given the correct arguments, error msg otherwise
+            # a trailing 'hashed' makes hashed directories the default
+            dirFormat = FileSystem.default_dirformat
+            if words[-1] == 'hashed':
+                dirFormat = FileSystem.dir_format_hashed
+                words = words[:-1]
+                numWords -= 1
             if numWords < 3 or numWords > 4:
-                print("Error: newfs - requires two arguments: 'newfs <filename> <block count> [optinal blocksize]'")
+                print("Error: newfs - requires two arguments: 'newfs <filename> <block count> [optinal blocksize] [hashed]'")
             elif numWords == 4:
-                FileSystem.FileSystem.createFileSystem(words[1], int(words[2]), int(words[3]))
+                FileSystem.FileSystem.createFileSystem(words[1], int(words[2]), int(words[3]), dirFormat=dirFormat)
             else:
-                FileSystem.FileSystem.createFileSystem(words[1], int(words[2]))
+                FileSystem.FileSystem.createFileSystem(words[1], int(words[2]), dirFormat=dirFormat)
         elif words[0] == 'mount':
             # Mounts filesystem from current directory, reference stored in fileSys
             if numWords != 2:
@@ -154,6 +174,24 @@ def repl():
             else:
                 fileSys.freeINode(int(words[1]))
 
+        elif words[0] == 'sync':
+            # write changed blocks to disk, leaving the fileSys mounted
+            if numWords != 1:
+                print("Error: sync - requires no arguments'")
+            elif fileSys is None:
+                print("Error: sync - no file system mounted'")
+            else:
+                fileSys.sync()
+
+        elif words[0] == 'cache_stats':
+            # displays block cache occupancy and hit/miss counters
+            if numWords != 1:
+                print("Error: cache_stats - requires no arguments'")
+            elif fileSys is None:
+                print("Error: cache_stats - no file system mounted'")
+            else:
+                fileSys.printCacheStats()
+
         elif words[0] == 'unmount':
             # flush values to disk and set fileSys to None
             if numWords != 1: